@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import time
+
+import aiohttp.web
+
+logger = logging.getLogger("fake_discord")
+
+
+class FakeDiscord:
+    def __init__(self, host="127.0.0.1", port=8765, bucket_size=5, bucket_window=2.0, random_429=0.0):
+        self.host = host
+        self.port = port
+        # roughly Discord's webhook execute limit: bucket_size posts per bucket_window
+        self.bucket_size = bucket_size
+        self.bucket_window = bucket_window
+        self.random_429 = random_429
+        self.buckets = {}
+        self.message_ids = itertools.count(1)
+        self.statuses = {}
+        self.posts = 0
+        self.edits = 0
+        self.on_post = None
+        self.runner = None
+
+    @property
+    def api_base(self):
+        return f"http://{self.host}:{self.port}/api"
+
+    async def start(self):
+        app = aiohttp.web.Application()
+        app.router.add_post("/api/webhooks/{webhook_id}/{token}", self.execute)
+        app.router.add_patch("/api/webhooks/{webhook_id}/{token}/messages/{message_id}", self.edit)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await aiohttp.web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def take_token(self, webhook_id):
+        now = time.monotonic()
+        used, reset_at = self.buckets.get(webhook_id, (0, now + self.bucket_window))
+        if now >= reset_at:
+            used, reset_at = 0, now + self.bucket_window
+        if used >= self.bucket_size or random.random() < self.random_429:
+            self.buckets[webhook_id] = (used, reset_at)
+            return None, reset_at - now
+        used += 1
+        self.buckets[webhook_id] = (used, reset_at)
+        return self.bucket_size - used, reset_at - now
+
+    def respond(self, status, body, headers=None):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        return aiohttp.web.json_response(body, status=status, headers=headers)
+
+    async def execute(self, request):
+        webhook_id = request.match_info["webhook_id"]
+        remaining, reset_after = self.take_token(webhook_id)
+        if remaining is None:
+            return self.respond(429, {"message": "You are being rate limited.", "retry_after": round(reset_after, 3), "global": False},
+                                {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": f"{reset_after:.3f}"})
+        payload = await request.json()
+        self.posts += 1
+        if self.on_post is not None:
+            self.on_post(payload)
+        message_id = str(next(self.message_ids))
+        return self.respond(200, {"id": message_id, "webhook_id": webhook_id, "content": payload.get("content")},
+                            {"X-RateLimit-Remaining": str(remaining), "X-RateLimit-Reset-After": f"{reset_after:.3f}"})
+
+    async def edit(self, request):
+        payload = await request.json()
+        self.edits += 1
+        return self.respond(200, {"id": request.match_info["message_id"], "content": payload.get("content")})
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Local sink imitating Discord webhook responses")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--bucket-size", type=int, default=5)
+    parser.add_argument("--bucket-window", type=float, default=2.0)
+    parser.add_argument("--random-429", type=float, default=0.0)
+    args = parser.parse_args()
+    sink = FakeDiscord(args.host, args.port, args.bucket_size, args.bucket_window, args.random_429)
+    await sink.start()
+    logger.info(f"Fake Discord webhooks at {sink.api_base}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+import msgpack
+import zmq
+import zmq.asyncio
+
+logger = logging.getLogger("fake_llm")
+
+
+def parse_latency(spec):
+    # fixed:0.05 | uniform:0.02,0.2 | lognormal:mu,sigma (seconds)
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(values[0], values[1])
+    raise ValueError(f"Unknown latency distribution {spec}")
+
+
+def wobble(text):
+    return f"{text} wob" if text else "wob"
+
+
+class FakeLLM:
+    def __init__(self, endpoint, latency="fixed:0.05", models=("t5-mihm",), capabilities=("gen_batch", "chain", "gen_stream"), batch_item_cost=0.002, protocol=2):
+        self.endpoint = endpoint
+        self.latency = parse_latency(latency)
+        self.models = list(models)
+        self.capabilities = list(capabilities)
+        self.batch_item_cost = batch_item_cost
+        self.protocol = protocol
+        self.profiles = {}
+        self.requests = {}
+        self.expired = 0
+        self.context = zmq.asyncio.Context()
+        self.socket = None
+        self.task = None
+
+    async def start(self):
+        # ROUTER serves both the bot's DEALER traffic and its REQ heartbeats
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(self.endpoint)
+        self.task = asyncio.get_running_loop().create_task(self.serve())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.socket.close(linger=0)
+
+    async def serve(self):
+        while True:
+            frames = await self.socket.recv_multipart()
+            asyncio.get_running_loop().create_task(self.handle(frames[:-1], msgpack.unpackb(frames[-1])))
+
+    async def reply(self, envelope, response):
+        await self.socket.send_multipart(envelope + [msgpack.packb(response)])
+
+    def expired_for(self, request):
+        # like a real backend, don't bother answering a caller that has given up
+        deadline = request.get("deadline")
+        if deadline is not None and time.time() > deadline:
+            self.expired += 1
+            return True
+        return False
+
+    async def handle(self, envelope, request):
+        kind = request.get("type")
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+        if kind == "ping":
+            return await self.reply(envelope, "pong")
+        if self.protocol >= 2:
+            if kind == "hello":
+                return await self.reply(envelope, {"protocol": max(v for v in request.get("protocols", [1]) if v <= self.protocol)})
+            if kind == "register_profile":
+                profile_id = len(self.profiles) + 1
+                self.profiles[profile_id] = {key: value for key, value in request.items() if key != "type"}
+                return await self.reply(envelope, {"profile": profile_id})
+            if "profile" in request:
+                profile = self.profiles.get(request.pop("profile"))
+                if profile is None:
+                    return await self.reply(envelope, {"error": "unknown_profile"})
+                request = dict(profile, **request)
+        if kind == "get_models":
+            return await self.reply(envelope, self.models)
+        if kind == "get_capabilities":
+            return await self.reply(envelope, self.capabilities)
+        if kind == "gen":
+            await asyncio.sleep(self.latency())
+            if self.expired_for(request):
+                return
+            return await self.reply(envelope, wobble(request.get("text")))
+        if kind == "gen_batch":
+            texts = request.get("texts") or []
+            await asyncio.sleep(self.latency() + self.batch_item_cost * len(texts))
+            if self.expired_for(request):
+                return
+            return await self.reply(envelope, [wobble(text) for text in texts])
+        if kind == "chain":
+            outputs = []
+            current = request.get("text")
+            for _ in range(request.get("depth", 0) + 1):
+                if self.expired_for(request):
+                    return
+                await asyncio.sleep(self.latency())
+                current = wobble(current)
+                outputs.append(current)
+            return await self.reply(envelope, outputs)
+        if kind == "gen_stream":
+            words = wobble(request.get("text")).split(" ")
+            step = self.latency() / max(1, len(words))
+            for i, word in enumerate(words):
+                await asyncio.sleep(step)
+                await self.reply(envelope, {"chunk": word if i == 0 else f" {word}", "done": i == len(words) - 1})
+            return
+        await self.reply(envelope, {"error": f"unknown type {kind}"})
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Stand-in LLM backend speaking the translatiob msgpack protocol")
+    parser.add_argument("--endpoint", default="tcp://127.0.0.1:5556")
+    parser.add_argument("--latency", default="fixed:0.05")
+    parser.add_argument("--models", default="t5-mihm")
+    parser.add_argument("--capabilities", default="gen_batch,chain,gen_stream")
+    parser.add_argument("--protocol", type=int, default=2, choices=[1, 2])
+    args = parser.parse_args()
+    llm = FakeLLM(args.endpoint, args.latency, args.models.split(","), [c for c in args.capabilities.split(",") if c], protocol=args.protocol)
+    await llm.start()
+    logger.info(f"Fake LLM listening on {args.endpoint}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
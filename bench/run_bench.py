@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import importlib.util
+import itertools
+import logging
+import os
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from fake_discord import FakeDiscord
+from fake_llm import FakeLLM
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MARKER = re.compile(r"msg-(\d+)\b")
+ids = itertools.count(1_000_000)
+
+
+class FakeAvatar:
+    url = "https://i.imgur.com/NGvttCc.gif"
+
+
+class FakeAuthor:
+    # process_commands ignores bot authors, so only the translation path runs
+    bot = True
+
+    def __init__(self, author_id, name):
+        self.id = author_id
+        self.name = name
+        self.nick = None
+        self.display_name = name
+        self.avatar = FakeAvatar()
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeChannel:
+    bulk_deletes = 0
+
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+
+    async def delete_messages(self, messages):
+        FakeChannel.bulk_deletes += 1
+        FakeMessage.deleted += len(messages)
+
+
+class FakeMessage:
+    deleted = 0
+
+    def __init__(self, content, author, channel):
+        self.id = next(ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.webhook_id = None
+
+    async def delete(self):
+        FakeMessage.deleted += 1
+
+
+def load_config(overrides):
+    # the bot does `from config import *`, so register a config module before importing it
+    path = os.path.join(ROOT, "config.py")
+    if not os.path.exists(path):
+        path = os.path.join(ROOT, "config.example.py")
+    spec = importlib.util.spec_from_file_location("config", path)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    sys.modules["config"] = config
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def run(args):
+    endpoint = f"tcp://127.0.0.1:{args.llm_port}"
+    llm = FakeLLM(endpoint, args.latency, capabilities=[c for c in args.capabilities.split(",") if c], protocol=args.protocol)
+    sink = FakeDiscord(port=args.discord_port, bucket_size=args.bucket_size, bucket_window=args.bucket_window, random_429=args.random_429)
+    await llm.start()
+    await sink.start()
+
+    workdir = tempfile.mkdtemp(prefix="translatiob-bench-")
+    load_config({
+        "LLM_BACKENDS": [endpoint],
+        "DISCORD_API_BASE": sink.api_base,
+        "SETUP_DB": os.path.join(workdir, "setups.sqlite3"),
+        "SETUP_FILE": os.path.join(workdir, "setup_cache.json"),
+        "NICK_CACHE_FILE": None,
+        "METRICS_PORT": None,
+        "TIMEOUT": args.timeout * 1000,
+    })
+    sys.path.insert(0, ROOT)
+    import translatiob
+    bot = translatiob.bot
+    logging.getLogger().setLevel(args.log_level)
+
+    guild = FakeGuild(1)
+    channels = [FakeChannel(100 + i, guild) for i in range(args.channels)]
+    authors = [FakeAuthor(10_000 + i, f"user{i}") for i in range(args.authors)]
+    for channel in channels:
+        bot.put_setup(str(channel.id + channel.id), {
+            "created_in": channel.id,
+            "from_author": None,
+            "from_server": None,
+            "from_channel": channel.id,
+            "to_channel": channel.id,
+            "delete_messages": True,
+            "webhook_id": 500_000 + channel.id,
+            "webhook_token": "bench",
+            "model": "t5-mihm",
+            "disabled": False,
+            "delivery": args.delivery,
+            "recursion_depth": args.depth,
+        })
+
+    loop = asyncio.get_running_loop()
+    await bot.LLM.start(loop)
+    bot.scheduler.start(loop)
+    bot.models = await bot.LLM.refresh()
+    bot.probe_capabilities()
+
+    sent = {}
+    latencies = {}
+    finished = asyncio.Event()
+
+    def on_post(payload):
+        match = MARKER.search(payload.get("content") or "")
+        if match:
+            n = int(match.group(1))
+            if n in sent and n not in latencies:
+                latencies[n] = time.perf_counter() - sent[n]
+                if len(latencies) == args.messages:
+                    finished.set()
+
+    sink.on_post = on_post
+    started = time.perf_counter()
+    for n in range(args.messages):
+        if args.rate:
+            delay = started + n / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        message = FakeMessage(f"msg-{n} the quick brown fox jumps over the lazy dog", authors[n % len(authors)], channels[n % len(channels)])
+        sent[n] = time.perf_counter()
+        await bot.on_message(message)
+    try:
+        await asyncio.wait_for(finished.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+
+    values = list(latencies.values())
+    print(f"messages        {args.messages} sent, {len(values)} delivered in {elapsed:.2f}s")
+    print(f"throughput      {len(values) / elapsed:.1f} msg/s")
+    print(f"latency p50     {percentile(values, 0.5) * 1000:.1f} ms")
+    print(f"latency p99     {percentile(values, 0.99) * 1000:.1f} ms")
+    if values:
+        print(f"latency mean    {statistics.mean(values) * 1000:.1f} ms")
+    print(f"webhook posts   {sink.posts} (+{sink.edits} edits), statuses {sink.statuses}")
+    print(f"llm requests    {llm.requests} ({llm.expired} past deadline)")
+    print(f"deletes         {FakeMessage.deleted} ({FakeChannel.bulk_deletes} bulk calls)")
+    print(f"peak rss        {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+    await bot.deleter.close()
+    await bot.webhooks.close()
+    bot.setup_store.close(bot.setups)
+    await llm.stop()
+    await sink.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test: synthetic messages -> on_message -> fake LLM -> fake Discord webhooks")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--authors", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 sends as fast as possible")
+    parser.add_argument("--depth", type=int, default=0)
+    parser.add_argument("--delivery", default="each", choices=["each", "packed", "stream"])
+    parser.add_argument("--latency", default="fixed:0.05", help="fixed:S | uniform:A,B | lognormal:MU,SIGMA")
+    parser.add_argument("--capabilities", default="gen_batch,chain,gen_stream")
+    parser.add_argument("--protocol", type=int, default=2, choices=[1, 2])
+    parser.add_argument("--bucket-size", type=int, default=5)
+    parser.add_argument("--bucket-window", type=float, default=2.0)
+    parser.add_argument("--random-429", type=float, default=0.0)
+    parser.add_argument("--llm-port", type=int, default=15556)
+    parser.add_argument("--discord-port", type=int, default=18765)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--log-level", default="ERROR")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,4 +3,60 @@ AUTHORIZED_USER_IDS = []
 AUTHORIZED_ROLE_IDS = []
 TIMEOUT = 30000
 SETUP_FILE = 'setup_cache.json'
-MAX_RECURSION_DEPTH = 5 
\ No newline at end of file
+MAX_RECURSION_DEPTH = 5 
+MAX_INFLIGHT = 8
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT = 0.02
+TRANSLATION_CACHE_SIZE = 4096
+TRANSLATION_CACHE_TTL = 60*60
+TRANSLATION_CACHE_MAX_TEMPERATURE = 0.5
+TRANSLATION_CACHE_SAMPLED_TTL = 60
+NICK_CACHE_SIZE = 2048
+NICK_CACHE_TTL = 60*60*24
+NICK_CACHE_FILE = 'nick_cache.json'
+DISCORD_API_BASE = 'https://discord.com/api'
+WEBHOOK_MAX_CONCURRENCY = 16
+WEBHOOK_MAX_RETRIES = 3
+STREAM_EDIT_INTERVAL = 1.0
+SETUP_DB = 'setups.sqlite3'
+SETUP_SAVE_DEBOUNCE = 2.0
+WEBHOOK_DIRECTORY_TTL = 60*10
+ONBOARD_CONCURRENCY = 5
+ONBOARD_PROGRESS_INTERVAL = 2.0
+SCHEDULER_WORKERS = 16
+SCHEDULER_GUILD_DEPTH = 200
+SCHEDULER_SETUP_DEPTH = 50
+SCHEDULER_GUILD_RUNNING = 4
+SCHEDULER_POLICY = 'drop_oldest'
+SCHEDULER_GUILD_WEIGHTS = {}
+HEARTBEAT_TIMEOUT = 5000
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_BACKOFF = 5
+BREAKER_MAX_BACKOFF = 300
+BREAKER_SLOW_PROBE = 2.0
+BREAKER_SLOW_PERCENTILE = 0.99
+BREAKER_SLOW_MIN_SAMPLES = 20
+LLM_BACKENDS = ['tcp://127.0.0.1:5556']
+ROUTER_MAX_ATTEMPTS = 2
+ROUTER_REFRESH_INTERVAL = 60*5
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9464
+TRACE_SAMPLE_RATE = 0.0
+TRACE_SLOW_THRESHOLD = 10.0
+TRACE_PROFILE_RATE = 0.0
+CHUNK_MAX_CHARS = 500
+DELETE_WINDOW = 0.5
+SHARD_COUNT = None
+WORKER_ENDPOINT = 'ipc:///tmp/translatiob-worker.ipc'
+SETUP_SYNC_INTERVAL = 2.0
+SPOOL_FILE = 'spool.msgpack'
+SPOOL_MAX_ENTRIES = 50000
+SPOOL_MAX_AGE = 60*60*6
+SPOOL_MAX_ATTEMPTS = 5
+SPOOL_DRAIN_BACKLOG = 64
+SPOOL_DRAIN_JITTER = 5.0
+SPOOL_DRAIN_PER_SETUP = 8
+INTERACTIVE_BUDGET = 15.0
+MESSAGE_BUDGET = 20.0
+HEDGE_PERCENTILE = None
+HEDGE_MIN_SAMPLES = 20
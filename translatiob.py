@@ -2,10 +2,27 @@ import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 import zmq
+import zmq.asyncio
 import msgpack
-import requests
+import aiohttp
+import aiohttp.web
 import asyncio
+import bisect
+import contextlib
+import contextvars
+import cProfile
+import pstats
+import io
+import itertools
+import time
 import json
+import sqlite3
+import threading
+import os
+import sys
+import re
+from collections import OrderedDict, deque
+from functools import partial
 import random
 import logging
 import traceback
@@ -18,78 +35,1553 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+DELIVERY_MODES = ["each", "packed", "stream"]
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PASSIVE = 1
+WEBHOOK_NAME = 'GUANGDONG CAWOLO HARRAQ TECHNOLOGY CO., LTD'
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, label_values, value
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None, kind=None):
+        super().__init__(name, help, labels)
+        # fn is read at scrape time and returns {label values: value}
+        self.fn = fn
+        if kind is not None:
+            self.kind = kind
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def samples(self):
+        values = self.fn() if self.fn is not None else self.values
+        for label_values, value in values.items():
+            yield self.name, label_values, value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", label_values + (("le", "+Inf" if bound == float("inf") else repr(bound)),), cumulative
+            yield f"{self.name}_sum", label_values, total
+            yield f"{self.name}_count", label_values, count
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, label_values, value in metric.samples():
+                labels = []
+                for i, label_value in enumerate(label_values):
+                    label, label_value = label_value if isinstance(label_value, tuple) else (metric.labels[i], label_value)
+                    escaped = str(label_value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                    labels.append(f'{label}="{escaped}"')
+                lines.append(f"{name}{{{','.join(labels)}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        if self.server is not None:
+            return
+        app = aiohttp.web.Application()
+        app.router.add_get("/metrics", self.handle)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        self.server = aiohttp.web.TCPSite(runner, host, port)
+        await self.server.start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def handle(self, request):
+        return aiohttp.web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+METRICS = MetricsRegistry()
+LLM_REQUEST_SECONDS = METRICS.register(Histogram("translatiob_llm_request_seconds", "LLM backend round trip time", ("backend", "model", "type")))
+LLM_REQUEST_FAILURES = METRICS.register(Counter("translatiob_llm_request_failures_total", "LLM backend requests that failed", ("backend", "type", "reason")))
+LLM_HEARTBEATS = METRICS.register(Counter("translatiob_llm_heartbeats_total", "LLM backend heartbeat results", ("backend", "result")))
+CHAIN_LENGTH = METRICS.register(Histogram("translatiob_chain_length", "Outputs per recursion chain", (), buckets=tuple(range(MAX_RECURSION_DEPTH + 2))))
+LLM_HEDGES = METRICS.register(Counter("translatiob_llm_hedges_total", "Hedged LLM requests by which copy answered first", ("type", "winner")))
+WEBHOOK_SECONDS = METRICS.register(Histogram("translatiob_webhook_request_seconds", "Webhook HTTP request time", ("method",)))
+WEBHOOK_RESPONSES = METRICS.register(Counter("translatiob_webhook_responses_total", "Webhook HTTP responses by status", ("method", "status")))
+MESSAGE_DELETES = METRICS.register(Counter("translatiob_message_deletes_total", "Source messages deleted", ("mode", "result")))
+
+CURRENT_TRACE = contextvars.ContextVar("translatiob_trace", default=None)
+NO_SPAN = contextlib.nullcontext()
+
+def trace_span(name):
+    trace = CURRENT_TRACE.get()
+    return trace.span(name) if trace is not None else NO_SPAN
+
+# absolute wall clock time, it travels with requests to other processes
+CURRENT_DEADLINE = contextvars.ContextVar("translatiob_deadline", default=None)
+
+def remaining_budget():
+    deadline = CURRENT_DEADLINE.get()
+    return None if deadline is None else deadline - time.time()
+
+@contextlib.contextmanager
+def deadline_scope(deadline):
+    # a nested scope can only tighten the deadline it runs under
+    current = CURRENT_DEADLINE.get()
+    if deadline is None or (current is not None and current <= deadline):
+        yield
+        return
+    token = CURRENT_DEADLINE.set(deadline)
+    try:
+        yield
+    finally:
+        CURRENT_DEADLINE.reset(token)
+
+async def within_deadline(deadline, fn, *args):
+    with deadline_scope(deadline):
+        return await fn(*args)
+
+class Trace:
+    def __init__(self, name, profiler=None):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+        self.refs = 1
+        self.profiler = profiler
+
+    def record(self, name, start, end):
+        self.spans.append((name, start - self.started, end - start))
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def format(self):
+        total = time.perf_counter() - self.started
+        spans = " | ".join(f"{name} +{offset * 1000:.1f}ms {duration * 1000:.1f}ms" for name, offset, duration in sorted(self.spans, key=lambda span: span[1]))
+        return f"trace {self.name} {total * 1000:.1f}ms: {spans}"
+
+class Tracer:
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, slow_threshold=TRACE_SLOW_THRESHOLD, profile_rate=TRACE_PROFILE_RATE):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.profile_rate = profile_rate
+        self.profiling = False
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def start(self, name):
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        profiler = None
+        # cProfile sees the whole thread, so only one sampled message is profiled at a time
+        if self.profile_rate and not self.profiling and random.random() < self.profile_rate:
+            self.profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return Trace(name, profiler)
+
+    def acquire(self, trace):
+        if trace is not None:
+            trace.refs += 1
+
+    def release(self, trace):
+        if trace is None:
+            return
+        trace.refs -= 1
+        if trace.refs > 0:
+            return
+        total = time.perf_counter() - trace.started
+        if trace.profiler is not None:
+            trace.profiler.disable()
+            self.profiling = False
+        if total >= self.slow_threshold:
+            self.logger.warning(f"Slow {trace.format()}")
+            if trace.profiler is not None:
+                stats = io.StringIO()
+                pstats.Stats(trace.profiler, stream=stats).sort_stats("cumulative").print_stats(25)
+                self.logger.warning(stats.getvalue())
+        else:
+            self.logger.debug(trace.format())
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, backoff=BREAKER_BACKOFF, max_backoff=BREAKER_MAX_BACKOFF, slow_probe=BREAKER_SLOW_PROBE):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_probe = slow_probe
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.backoff = backoff
+        self.state = "closed"
+        self.failures = 0
+        self.retry_at = 0
+        self.latency = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def allow(self):
+        return self.state == "closed"
+
+    def probe_due(self, last_probe, interval):
+        if self.state == "closed":
+            return time.monotonic() - last_probe >= interval
+        return time.monotonic() >= self.retry_at
+
+    def begin_probe(self):
+        if self.state == "open":
+            self.state = "half_open"
+
+    def record_success(self, latency=None):
+        if latency is not None:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.state != "closed":
+            self.logger.info(f"{self.name} breaker closed")
+        self.state = "closed"
+        self.failures = 0
+        self.backoff = self.base_backoff
+
+    def record_probe(self, latency):
+        # a backend that takes this long to answer a ping is too busy to serve
+        # anything, count it like a missed one
+        if self.slow_probe is not None and latency > self.slow_probe:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.record_failure()
+            return False
+        self.record_success(latency)
+        return True
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.retry_at = time.monotonic() + self.backoff
+            self.logger.warning(f"{self.name} breaker open after {self.failures} failures, probing again in {self.backoff}s")
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+
+PROTOCOL_VERSIONS = [1, 2]
+# generation is idempotent, so these are safe to send twice
+HEDGE_TYPES = ("gen", "gen_batch", "chain")
+
+def msgpack_map_header(size):
+    if size < 16:
+        return bytes([0x80 | size])
+    return b"\xde" + size.to_bytes(2, "big")
+
+def msgpack_pairs(items):
+    return b"".join(msgpack.packb(key) + msgpack.packb(value) for key, value in items)
+
+class GenProfile:
+    # the generation settings shared by every request for one model, encoded
+    # once; v2 backends get them registered and are sent only the profile id
+    def __init__(self, fields):
+        self.fields = fields
+        self.model = fields.get("model")
+        self.key = json.dumps(fields, sort_keys=True)
+        self.packed = msgpack_pairs(fields.items())
+
 class ZMQClient:
-    def __init__(self, port, layer_name, heartbeat_interval=60, timeout=60):
-        self.port = port
+    def __init__(self, endpoint, layer_name, heartbeat_interval=60, timeout=60, max_inflight=MAX_INFLIGHT):
+        self.endpoint = endpoint
         self.layer_name = layer_name
         self.heartbeat_interval = heartbeat_interval
         self.timeout = timeout
-        self.context = zmq.Context()
+        self.context = zmq.asyncio.Context()
         self.socket = self.create_zmq_socket()
-        self.is_available = True
+        # requests are multiplexed over one DEALER socket: each carries its id as
+        # an envelope frame, which REP and ROUTER backends both echo back
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.reader = None
+        # pings go over their own socket so they never queue behind real traffic
+        self.heartbeat_socket = self.create_heartbeat_socket()
+        self.breaker = CircuitBreaker(layer_name)
+        self.models = set()
+        self.capabilities = set()
+        # set once the backend has answered a capabilities probe
+        self.probed = False
+        self.outstanding = 0
+        # request type -> recent round trip times, read for hedge delays
+        self.latencies = {}
+        self.protocol = 1
+        # profile key -> pre-encoded {"profile": id} pair for this backend
+        self.profile_envelopes = {}
+        self.registrations = SingleFlight()
         self.logger = logging.getLogger(self.__class__.__name__)
-        
+
+    @property
+    def is_available(self):
+        return self.breaker.allow()
+
+    def latency_percentile(self, kind, percentile, min_samples):
+        samples = sorted(self.latencies.get(kind, ()))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(percentile * len(samples)))]
+
+    async def hello(self):
+        reply = await self.safe_send({"from": "translatiob", "type": "hello", "protocols": PROTOCOL_VERSIONS})
+        # backends that predate the handshake answer with an error or not at all
+        protocol = reply.get("protocol") if isinstance(reply, dict) else None
+        protocol = protocol if protocol in PROTOCOL_VERSIONS else 1
+        if protocol != self.protocol:
+            self.logger.info(f"{self.layer_name} speaks protocol v{protocol}")
+            self.profile_envelopes.clear()
+        self.protocol = protocol
+
+    async def profile_envelope(self, profile):
+        envelope = self.profile_envelopes.get(profile.key)
+        if envelope is None:
+            envelope = await self.registrations.do(profile.key, partial(self.register_profile, profile))
+        return envelope
+
+    async def register_profile(self, profile):
+        reply = await self.safe_send(dict(profile.fields, type="register_profile"))
+        if not isinstance(reply, dict) or reply.get("profile") is None:
+            self.logger.warning(f"{self.layer_name} did not register a profile for {profile.model}: {reply}")
+            if isinstance(reply, dict) and reply.get("error"):
+                # refused outright, stay on inline settings until the next handshake
+                self.protocol = 1
+            return None
+        envelope = self.profile_envelopes[profile.key] = msgpack_pairs([("profile", reply["profile"])])
+        return envelope
+
+    async def encode(self, message):
+        profile = message.get("profile")
+        if profile is None:
+            return msgpack.packb(message)
+        # the model only rides along for routing and metrics, the profile carries it
+        items = [(key, value) for key, value in message.items() if key not in ("profile", "model")]
+        extra = msgpack_pairs(items)
+        if self.protocol >= 2:
+            envelope = await self.profile_envelope(profile)
+            if envelope is not None:
+                return msgpack_map_header(len(items) + 1) + envelope + extra
+        return msgpack_map_header(len(items) + len(profile.fields)) + profile.packed + extra
+
+    def forget_profile(self, message, response):
+        # a restarted backend loses its profiles, register again and retry once
+        profile = message.get("profile")
+        if profile is None or not isinstance(response, dict) or response.get("error") != "unknown_profile":
+            return False
+        self.profile_envelopes.pop(profile.key, None)
+        return True
+
     async def start(self, loop):
+        self.ensure_reader()
         loop.create_task(self.heartbeat_task())
 
     def create_zmq_socket(self):
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoint)
+        return socket
+
+    def create_heartbeat_socket(self):
         socket = self.context.socket(zmq.REQ)
-        socket.setsockopt(zmq.RCVTIMEO, self.timeout)
-        socket.connect(f"tcp://127.0.0.1:{self.port}")
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RCVTIMEO, HEARTBEAT_TIMEOUT)
+        socket.connect(self.endpoint)
         return socket
 
-    def safe_send(self, message):
-        try:
-            self.is_available = True
-            packed_data = msgpack.packb(message)
-            self.socket.send(packed_data)
-            response = self.socket.recv()
-            return msgpack.unpackb(response)
-        except zmq.Again as e:
-            self.is_available = False
-            self.logger.error(f"Timeout while waiting for a response: {e}")
-            return None
-        except zmq.ZMQError as e:
-            self.is_available = False
-            self.logger.error(f"ZMQ Error: {e}, attempting to reconnect...")
-            self.reconnect_socket()
-            return None
-        except Exception as e:
-            self.is_available = False
-            self.logger.error(f"Error sending message: {e}")
+    def ensure_reader(self):
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.get_running_loop().create_task(self.recv_loop(self.socket))
+
+    async def recv_loop(self, socket):
+        while True:
+            try:
+                frames = await socket.recv_multipart()
+            except asyncio.CancelledError:
+                raise
+            except zmq.ZMQError as e:
+                self.logger.error(f"ZMQ Error while receiving: {e}")
+                return
+            if len(frames) < 2:
+                self.logger.warning(f"Malformed reply from {self.layer_name}: {frames}")
+                continue
+            target = self.pending.get(frames[0])
+            if isinstance(target, asyncio.Queue):
+                target.put_nowait(frames[-1])
+            elif target is not None and not target.done():
+                target.set_result(frames[-1])
+            else:
+                self.logger.debug(f"Dropping late reply {frames[0].hex()} from {self.layer_name}")
+
+    async def safe_send(self, message):
+        # fail fast while the backend is known to be down
+        if not self.breaker.allow():
             return None
+        self.outstanding += 1
+        try:
+            response = await self._send(message)
+            if self.forget_profile(message, response):
+                response = await self._send(message)
+            return response
+        finally:
+            self.outstanding -= 1
+
+    async def _send(self, message):
+        timeout = self.timeout / 1000
+        deadline = CURRENT_DEADLINE.get()
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                LLM_REQUEST_FAILURES.inc(self.endpoint, message.get("type"), "deadline")
+                return None
+            # the backend drops work nobody is waiting for anymore
+            message = dict(message, deadline=deadline)
+            timeout = min(timeout, remaining)
+        # registering a profile is a request of its own, so encode outside the semaphore
+        packed_data = await self.encode(message)
+        async with self.inflight:
+            self.ensure_reader()
+            request_id = next(self.request_ids).to_bytes(8, "big")
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            try:
+                started = time.monotonic()
+                await self.socket.send_multipart([request_id, b"", packed_data])
+                response = await asyncio.wait_for(future, timeout)
+                elapsed = time.monotonic() - started
+                self.breaker.record_success(elapsed)
+                LLM_REQUEST_SECONDS.observe(elapsed, self.endpoint, message.get("model"), message.get("type"))
+                self.latencies.setdefault(message.get("type"), deque(maxlen=256)).append(elapsed)
+                return msgpack.unpackb(response)
+            except asyncio.TimeoutError:
+                # a caller's budget that ran out before the backend was overdue says
+                # nothing about it; waiting longer than nearly all of its round trips
+                # with no reply does, even when the budget is shorter than the timeout
+                usual = self.latency_percentile(message.get("type"), BREAKER_SLOW_PERCENTILE, BREAKER_SLOW_MIN_SAMPLES)
+                if timeout < self.timeout / 1000 and usual is not None and timeout < usual:
+                    LLM_REQUEST_FAILURES.inc(self.endpoint, message.get("type"), "deadline")
+                    self.logger.warning(f"Deadline passed waiting for {message.get('type')} from {self.layer_name}")
+                    return None
+                self.breaker.record_failure()
+                LLM_REQUEST_FAILURES.inc(self.endpoint, message.get("type"), "timeout")
+                self.logger.error(f"Timeout while waiting for a response from {self.layer_name}")
+                return None
+            except zmq.ZMQError as e:
+                self.breaker.record_failure()
+                LLM_REQUEST_FAILURES.inc(self.endpoint, message.get("type"), "zmq")
+                self.logger.error(f"ZMQ Error: {e}, attempting to reconnect...")
+                self.reconnect_socket()
+                return None
+            except ConnectionError as e:
+                # failed by reconnect_socket; the error behind the reconnect already
+                # counted, every request caught in it shouldn't count again
+                LLM_REQUEST_FAILURES.inc(self.endpoint, message.get("type"), "lost")
+                self.logger.error(f"Request to {self.layer_name} lost: {e}")
+                return None
+            except Exception as e:
+                self.logger.error(f"Error sending message: {e}")
+                return None
+            finally:
+                self.pending.pop(request_id, None)
+
+    async def stream(self, message):
+        # streamed replies arrive as several frames under one request id, each
+        # a {"chunk": ..., "done": ...} map; the last one has done set
+        if not self.breaker.allow():
+            return
+        self.outstanding += 1
+        try:
+            async with contextlib.aclosing(self._stream(message)) as parts:
+                async for part in parts:
+                    yield part
+        finally:
+            self.outstanding -= 1
+
+    async def _stream(self, message):
+        deadline = CURRENT_DEADLINE.get()
+        if deadline is not None:
+            if deadline <= time.time():
+                LLM_REQUEST_FAILURES.inc(self.endpoint, message.get("type"), "deadline")
+                return
+            message = dict(message, deadline=deadline)
+        packed_data = await self.encode(message)
+        async with self.inflight:
+            self.ensure_reader()
+            request_id = next(self.request_ids).to_bytes(8, "big")
+            queue = asyncio.Queue()
+            self.pending[request_id] = queue
+            try:
+                await self.socket.send_multipart([request_id, b"", packed_data])
+                while True:
+                    timeout = self.timeout / 1000
+                    if deadline is not None:
+                        timeout = min(timeout, deadline - time.time())
+                    payload = await asyncio.wait_for(queue.get(), timeout)
+                    if payload is None:
+                        return
+                    part = msgpack.unpackb(payload)
+                    yield part
+                    if not isinstance(part, dict) or part.get("done"):
+                        return
+            except asyncio.TimeoutError:
+                if deadline is not None and deadline <= time.time():
+                    LLM_REQUEST_FAILURES.inc(self.endpoint, message.get("type"), "deadline")
+                    self.logger.warning(f"Deadline passed while streaming from {self.layer_name}")
+                    return
+                self.breaker.record_failure()
+                self.logger.error(f"Timeout while streaming from {self.layer_name}")
+            except zmq.ZMQError as e:
+                self.breaker.record_failure()
+                self.logger.error(f"ZMQ Error: {e}, attempting to reconnect...")
+                self.reconnect_socket()
+            finally:
+                self.pending.pop(request_id, None)
 
     def reconnect_socket(self):
         self.logger.debug(f"Reconnecting {self.layer_name} socket")
-        self.socket.close()
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        # replies to anything still in flight would come back on the old socket
+        for target in self.pending.values():
+            if isinstance(target, asyncio.Queue):
+                target.put_nowait(None)
+            elif not target.done():
+                target.set_exception(ConnectionError("socket reconnected"))
+        self.socket.close(linger=0)
         self.socket = self.create_zmq_socket()
 
+    async def ping(self):
+        try:
+            await self.heartbeat_socket.send(msgpack.packb({"from": "hiran", "type": "ping"}))
+            return msgpack.unpackb(await self.heartbeat_socket.recv())
+        except Exception as e:
+            self.logger.error(f"Failed heartbeat for {self.layer_name}: {e}")
+            # a REQ socket that missed its reply can't send again
+            self.heartbeat_socket.close(linger=0)
+            self.heartbeat_socket = self.create_heartbeat_socket()
+            return None
+
     async def heartbeat_task(self):
+        last_probe = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            # while open the breaker decides when to probe, backing off exponentially
+            if not self.breaker.probe_due(last_probe, self.heartbeat_interval):
+                continue
+            self.breaker.begin_probe()
+            started = last_probe = time.monotonic()
+            response = await self.ping()
+            if response and self.breaker.record_probe(time.monotonic() - started):
+                LLM_HEARTBEATS.inc(self.endpoint, "ok")
+                self.logger.debug(f"Heartbeat response from {self.layer_name}: {response}")
+            elif response:
+                LLM_HEARTBEATS.inc(self.endpoint, "slow")
+                self.logger.warning(f"Slow heartbeat from {self.layer_name}: {self.breaker.latency:.2f}s average")
+            else:
+                self.breaker.record_failure()
+                LLM_HEARTBEATS.inc(self.endpoint, "failed")
+                self.logger.error(f"No response from {self.layer_name} during heartbeat")
+
+class BackendRouter:
+    def __init__(self, endpoints, timeout=TIMEOUT, max_attempts=ROUTER_MAX_ATTEMPTS, refresh_interval=ROUTER_REFRESH_INTERVAL, hedge_percentile=HEDGE_PERCENTILE, hedge_min_samples=HEDGE_MIN_SAMPLES):
+        self.backends = [ZMQClient(endpoint, layer_name=f"LLM[{endpoint}]", timeout=timeout) for endpoint in endpoints]
+        self.max_attempts = max_attempts
+        self.refresh_interval = refresh_interval
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        # called after every periodic refresh
+        self.on_refresh = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def is_available(self):
+        return any(backend.is_available for backend in self.backends)
+
+    async def start(self, loop):
+        for backend in self.backends:
+            await backend.start(loop)
+        loop.create_task(self.refresh_task())
+
+    async def refresh_backend(self, backend):
+        await backend.hello()
+        models = await backend.safe_send({"from": "translatiob", "type": "get_models"})
+        if isinstance(models, list):
+            backend.models = set(models)
+        capabilities = await backend.safe_send({"from": "translatiob", "type": "get_capabilities"})
+        # no answer says nothing about what it can do, keep what we knew
+        if capabilities is not None:
+            backend.capabilities = set(capabilities) if isinstance(capabilities, (list, dict)) else set()
+            backend.probed = True
+
+    async def refresh(self):
+        # every backend reports its own models and capabilities
+        await asyncio.gather(*(self.refresh_backend(backend) for backend in self.backends))
+        return self.models()
+
+    async def refresh_task(self):
         while True:
-            await asyncio.sleep(self.heartbeat_interval)
+            # come back soon while a reachable backend has never answered the probe
+            unprobed = any(backend.is_available and not backend.probed for backend in self.backends)
+            await asyncio.sleep(min(self.refresh_interval, 5) if unprobed else self.refresh_interval)
+            await self.refresh()
+            if self.on_refresh is not None:
+                self.on_refresh()
+
+    def models(self):
+        return sorted(set().union(*(backend.models for backend in self.backends)))
+
+    def capabilities(self):
+        # only advertise what every backend can do, requests may land anywhere; a
+        # backend that is down or never answered takes no requests and has no say
+        backends = [backend for backend in self.backends if backend.is_available and backend.probed]
+        return set.intersection(*(backend.capabilities for backend in backends)) if backends else set()
+
+    def pick(self, model, exclude=()):
+        candidates = [b for b in self.backends if b not in exclude and b.is_available and (model is None or not b.models or model in b.models)]
+        if not candidates:
+            return None
+        # least outstanding requests, preferring a backend that is known to host the model
+        return min(candidates, key=lambda b: (model is not None and model not in b.models, b.outstanding))
+
+    async def safe_send(self, message):
+        tried = []
+        for attempt in range(self.max_attempts):
+            budget = remaining_budget()
+            if budget is not None and budget <= 0:
+                break
+            backend = self.pick(message.get("model"), tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            response = await self.send_hedged(backend, message, tried)
+            if response is not None:
+                return response
+            self.logger.warning(f"{backend.layer_name} failed {message.get('type')}, trying another backend")
+        return None
+
+    def hedge_delay(self, kind):
+        if not self.hedge_percentile or kind not in HEDGE_TYPES:
+            return None
+        samples = sorted(itertools.chain.from_iterable(backend.latencies.get(kind, ()) for backend in self.backends))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(self.hedge_percentile * len(samples)))]
+
+    async def send_hedged(self, backend, message, tried):
+        delay = self.hedge_delay(message.get("type"))
+        budget = remaining_budget()
+        if delay is None or (budget is not None and budget <= delay):
+            return await backend.safe_send(message)
+        primary = asyncio.ensure_future(backend.safe_send(message))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return primary.result()
+            # slower than most requests of its kind, race a second copy against it,
+            # on another backend when there is one
+            hedge_backend = self.pick(message.get("model"), tried) or backend
+            if hedge_backend not in tried:
+                tried.append(hedge_backend)
+            hedge = asyncio.ensure_future(hedge_backend.safe_send(message))
+            tasks.add(hedge)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result() is not None:
+                        LLM_HEDGES.inc(message.get("type"), "hedge" if task is hedge else "primary")
+                        return task.result()
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream(self, message):
+        backend = self.pick(message.get("model"))
+        if backend is None:
+            return
+        async with contextlib.aclosing(backend.stream(message)) as parts:
+            async for part in parts:
+                yield part
+
+class TTLCache:
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is not None:
+            value, stamp = entry
+            if self.ttl is None or time.time() - stamp < self.ttl:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self.data[key] = (value, time.time())
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def prune(self):
+        if self.ttl is None:
+            return 0
+        cutoff = time.time() - self.ttl
+        expired = [k for k, (_, stamp) in self.data.items() if stamp < cutoff]
+        for k in expired:
+            del self.data[k]
+        return len(expired)
+
+    def dump(self):
+        return [(key, value, stamp) for key, (value, stamp) in self.data.items()]
+
+    def load(self, entries):
+        cutoff = time.time() - self.ttl if self.ttl is not None else None
+        for key, value, stamp in entries:
+            if cutoff is None or stamp >= cutoff:
+                self.data[key] = (value, stamp)
+                self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0
+
+    async def do(self, key, fn):
+        future = self.calls.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # followers re-raise it themselves, don't warn about it going unseen
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self.calls[key]
+
+class GenBatch:
+    def __init__(self, template):
+        self.template = template
+        self.texts = []
+        self.futures = []
+        self.handle = None
+        self.deadline = None
+        self.unbounded = False
+
+class GenBatcher:
+    def __init__(self, client, max_batch_size=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT):
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # only switched on once the backend advertises "gen_batch"
+        self.enabled = False
+        self.batches = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def batch_key(self, message):
+        return message.get("profile")
+
+    async def send(self, message):
+        if not self.enabled or message.get("type") != "gen" or self.max_batch_size <= 1:
+            return await self.client.safe_send(message)
+        key = self.batch_key(message)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = GenBatch(message)
+            batch.handle = asyncio.get_running_loop().call_later(self.max_wait, self.schedule_flush, key, batch)
+            self.batches[key] = batch
+        future = asyncio.get_running_loop().create_future()
+        batch.texts.append(message["text"])
+        batch.futures.append(future)
+        # the batch is worth finishing until its most patient caller gives up
+        deadline = CURRENT_DEADLINE.get()
+        if deadline is None:
+            batch.unbounded = True
+        else:
+            batch.deadline = max(batch.deadline or deadline, deadline)
+        if len(batch.texts) >= self.max_batch_size:
+            self.schedule_flush(key, batch)
+        return await future
+
+    def schedule_flush(self, key, batch):
+        if self.batches.get(key) is not batch:
+            return
+        del self.batches[key]
+        batch.handle.cancel()
+        asyncio.get_running_loop().create_task(self.flush(batch))
+
+    async def flush(self, batch):
+        # runs in its own task, so this doesn't leak into the callers
+        CURRENT_DEADLINE.set(None if batch.unbounded else batch.deadline)
+        try:
+            if len(batch.texts) == 1:
+                results = [await self.client.safe_send(dict(batch.template, text=batch.texts[0]))]
+            else:
+                message = dict(batch.template, type="gen_batch", texts=batch.texts)
+                del message["text"]
+                results = await self.client.safe_send(message)
+                if not isinstance(results, list) or len(results) != len(batch.texts):
+                    self.logger.warning(f"Bad gen_batch reply for {len(batch.texts)} texts, retrying one by one")
+                    results = await asyncio.gather(*(self.client.safe_send(dict(batch.template, text=text)) for text in batch.texts))
+        except Exception as e:
+            self.logger.error(f"Batch flush failed: {e}")
+            results = [None] * len(batch.futures)
+        for future, result in zip(batch.futures, results):
+            if not future.done():
+                future.set_result(result)
+
+class DeleteBatch:
+    def __init__(self, channel):
+        self.channel = channel
+        self.messages = []
+        self.handle = None
+
+class MessageDeleter:
+    def __init__(self, window=DELETE_WINDOW, max_batch_size=100):
+        self.window = window
+        # Discord bulk deletes take at most 100 messages
+        self.max_batch_size = max_batch_size
+        self.batches = {}
+        self.recent = TTLCache(4096, 60*5)
+        self.tasks = set()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def submit(self, message):
+        if self.recent.get(message.id):
+            return
+        self.recent.set(message.id, True)
+        channel_id = message.channel.id
+        batch = self.batches.get(channel_id)
+        if batch is None:
+            batch = self.batches[channel_id] = DeleteBatch(message.channel)
+            batch.handle = asyncio.get_running_loop().call_later(self.window, self.schedule_flush, channel_id, batch)
+        batch.messages.append(message)
+        if len(batch.messages) >= self.max_batch_size:
+            self.schedule_flush(channel_id, batch)
+
+    def schedule_flush(self, channel_id, batch):
+        if self.batches.get(channel_id) is not batch:
+            return
+        del self.batches[channel_id]
+        batch.handle.cancel()
+        task = asyncio.get_running_loop().create_task(self.flush(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self, batch):
+        if len(batch.messages) > 1 and hasattr(batch.channel, "delete_messages"):
             try:
-                response = self.safe_send({"from": "hiran", "type": "ping"})
-                if response:
-                    self.is_available = True
-                    self.logger.debug(f"Heartbeat response from {self.layer_name}: {response}")
-                else:
-                    self.is_available = False
-                    self.logger.error(f"No response from {self.layer_name} during heartbeat")
+                await batch.channel.delete_messages(batch.messages)
+                MESSAGE_DELETES.inc("bulk", "ok", amount=len(batch.messages))
+                return
+            except discord.HTTPException as e:
+                self.logger.warning(f"Bulk delete of {len(batch.messages)} messages in {batch.channel.id} failed ({e}), deleting one by one")
+        await asyncio.gather(*(self.delete_one(message) for message in batch.messages))
+
+    async def delete_one(self, message):
+        try:
+            await message.delete()
+            result = "ok"
+        except discord.NotFound:
+            result = "gone"
+        except Exception as e:
+            self.logger.warning(f"Could not delete message {message.id}: {e}")
+            result = "failed"
+        MESSAGE_DELETES.inc("single", result)
+
+    async def close(self):
+        for channel_id, batch in list(self.batches.items()):
+            self.schedule_flush(channel_id, batch)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+class SetupIndex:
+    def __init__(self, setups=None):
+        self.by_channel = {}
+        self.by_server = {}
+        self.by_author = {}
+        self.enabled_webhooks = {}
+        self.webhooks = {}
+        self.entries = {}
+        for key, setup in (setups or {}).items():
+            self.add(key, setup)
+
+    @staticmethod
+    def _link(table, value, key):
+        if value is not None:
+            table.setdefault(value, {})[key] = None
+
+    @staticmethod
+    def _unlink(table, value, key):
+        keys = table.get(value)
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del table[value]
+
+    def add(self, key, setup):
+        entry = (setup.get('from_channel'), setup.get('from_server'), setup.get('from_author'), setup.get('webhook_id'), not setup.get('disabled', False))
+        channel, server, author, webhook, enabled = entry
+        self.entries[key] = entry
+        self._link(self.webhooks, webhook, key)
+        if enabled:
+            self._link(self.by_channel, channel, key)
+            self._link(self.by_server, server, key)
+            self._link(self.by_author, author, key)
+            self._link(self.enabled_webhooks, webhook, key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        channel, server, author, webhook, enabled = entry
+        self._unlink(self.webhooks, webhook, key)
+        if enabled:
+            self._unlink(self.by_channel, channel, key)
+            self._unlink(self.by_server, server, key)
+            self._unlink(self.by_author, author, key)
+            self._unlink(self.enabled_webhooks, webhook, key)
+
+    def update(self, key, setup):
+        self.remove(key)
+        self.add(key, setup)
+
+    def is_own_webhook(self, webhook_id, enabled_only=True):
+        if webhook_id is None:
+            return False
+        return webhook_id in (self.enabled_webhooks if enabled_only else self.webhooks)
+
+    def match(self, channel_id, guild_id, author_id):
+        matched = {}
+        for table, value in ((self.by_channel, channel_id), (self.by_server, guild_id), (self.by_author, author_id)):
+            keys = table.get(value)
+            if keys:
+                matched.update(keys)
+        return list(matched)
+
+class WebhookResult:
+    def __init__(self, status, data=None, error=None, attempts=0):
+        self.status = status
+        self.data = data
+        self.error = error
+        self.attempts = attempts
+
+    @property
+    def ok(self):
+        return self.status is not None and 200 <= self.status < 300
+
+class WebhookDispatcher:
+    def __init__(self, api_base=DISCORD_API_BASE, max_concurrency=WEBHOOK_MAX_CONCURRENCY, max_retries=WEBHOOK_MAX_RETRIES, idle_timeout=60):
+        self.api_base = api_base
+        self.max_retries = max_retries
+        self.idle_timeout = idle_timeout
+        self.concurrency = asyncio.Semaphore(max_concurrency)
+        self.session = None
+        # one queue and worker per webhook keeps posts ordered and lets each
+        # webhook wait out its own rate limit bucket without blocking the rest
+        self.queues = {}
+        self.buckets = {}
+        self.global_reset_at = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    def submit(self, webhook_id, webhook_token, payload, message_id=None):
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(webhook_id)
+        if queue is None:
+            queue = self.queues[webhook_id] = asyncio.Queue()
+            asyncio.get_running_loop().create_task(self.worker(webhook_id, webhook_token, queue))
+        queue.put_nowait((payload, message_id, future))
+        return future
+
+    async def send(self, webhook_id, webhook_token, payload):
+        return await self.submit(webhook_id, webhook_token, payload)
+
+    async def edit(self, webhook_id, webhook_token, message_id, payload):
+        return await self.submit(webhook_id, webhook_token, payload, message_id=message_id)
+
+    async def worker(self, webhook_id, webhook_token, queue):
+        while True:
+            try:
+                payload, message_id, future = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self.queues[webhook_id]
+                    self.buckets.pop(webhook_id, None)
+                    return
+                continue
+            try:
+                result = await self.deliver(webhook_id, webhook_token, payload, message_id)
             except Exception as e:
-                self.is_available = False
+                self.logger.error(f"Webhook {webhook_id} delivery crashed: {e}")
+                result = WebhookResult(None, error=str(e))
+            if not future.done():
+                future.set_result(result)
+
+    async def wait_for_bucket(self, webhook_id):
+        now = time.monotonic()
+        delay = self.global_reset_at - now
+        remaining, reset_at = self.buckets.get(webhook_id, (1, 0))
+        if remaining <= 0:
+            delay = max(delay, reset_at - now)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def update_bucket(self, webhook_id, headers):
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None and reset_after is not None:
+            self.buckets[webhook_id] = (int(remaining), time.monotonic() + float(reset_after))
+
+    async def deliver(self, webhook_id, webhook_token, payload, message_id=None):
+        if message_id is None:
+            method, url = "POST", f"{self.api_base}/webhooks/{webhook_id}/{webhook_token}?wait=true"
+        else:
+            method, url = "PATCH", f"{self.api_base}/webhooks/{webhook_id}/{webhook_token}/messages/{message_id}"
+        error = None
+        for attempt in range(1, self.max_retries + 2):
+            await self.wait_for_bucket(webhook_id)
+            try:
+                async with self.concurrency:
+                    started = time.monotonic()
+                    async with self.get_session().request(method, url, json=payload) as response:
+                        body = await response.text()
+                        status = response.status
+                        headers = response.headers
+                    WEBHOOK_SECONDS.observe(time.monotonic() - started, method)
+                    WEBHOOK_RESPONSES.inc(method, status)
+                try:
+                    data = json.loads(body) if body else None
+                except json.JSONDecodeError:
+                    data = body
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                WEBHOOK_RESPONSES.inc(method, "error")
+                error = str(e)
+                self.logger.warning(f"Webhook {webhook_id} attempt {attempt} failed: {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            self.update_bucket(webhook_id, headers)
+            if status == 429:
+                info = data if isinstance(data, dict) else {}
+                retry_after = float(info.get("retry_after", headers.get("Retry-After", 1)))
+                if info.get("global") or headers.get("X-RateLimit-Global"):
+                    self.global_reset_at = time.monotonic() + retry_after
+                else:
+                    self.buckets[webhook_id] = (0, time.monotonic() + retry_after)
+                self.logger.warning(f"Webhook {webhook_id} rate limited, retrying in {retry_after}s")
+                continue
+            if status >= 500:
+                self.logger.warning(f"Webhook {webhook_id} got {status}, retrying")
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            return WebhookResult(status, data, attempts=attempt)
+        return WebhookResult(None, error=error or "retries exhausted", attempts=self.max_retries + 1)
+
+class SetupStore:
+    def __init__(self, path=SETUP_DB, legacy_file=SETUP_FILE, debounce=SETUP_SAVE_DEBOUNCE):
+        self.path = path
+        self.legacy_file = legacy_file
+        self.debounce = debounce
+        self.dirty = set()
+        # keys taken off dirty whose write hasn't committed yet, one set per flush
+        self.flushing = []
+        self.flush_handle = None
+        self.write_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS setups (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.commit()
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def load(self):
+        return self.rows() or self.migrate_legacy()
+
+    def rows(self):
+        with self.write_lock:
+            rows = self.conn.execute("SELECT key, data FROM setups").fetchall()
+        return {key: json.loads(data) for key, data in rows}
+
+    def changed(self):
+        # data_version moves whenever another connection (another shard) commits
+        with self.write_lock:
+            version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        changed, self.data_version = version != self.data_version, version
+        return changed
+
+    def migrate_legacy(self):
+        try:
+            with open(self.legacy_file, 'r') as f:
+                setups = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        self.write([(key, json.dumps(setup)) for key, setup in setups.items()], [])
+        os.replace(self.legacy_file, f"{self.legacy_file}.migrated")
+        self.logger.info(f"Migrated {len(setups)} setups from {self.legacy_file} to {self.path}")
+        return setups
+
+    def write(self, rows, deleted):
+        with self.write_lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO setups (key, data) VALUES (?, ?)", rows)
+            self.conn.executemany("DELETE FROM setups WHERE key = ?", [(key,) for key in deleted])
+
+    def mark(self, setups, keys):
+        self.dirty.update(keys)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_now(setups)
+            return
+        # bursts of changes within the debounce window go out as one transaction
+        if self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.debounce, lambda: loop.create_task(self.flush(setups)))
+
+    def take_dirty(self, setups):
+        self.flush_handle = None
+        dirty, self.dirty = self.dirty, set()
+        rows = [(key, json.dumps(setups[key])) for key in dirty if key in setups]
+        deleted = [key for key in dirty if key not in setups]
+        return rows, deleted
+
+    @property
+    def pending(self):
+        # changed here but not in the store yet, whatever another shard wrote
+        return self.dirty.union(*self.flushing)
+
+    async def flush(self, setups):
+        rows, deleted = self.take_dirty(setups)
+        if rows or deleted:
+            keys = {key for key, _ in rows} | set(deleted)
+            self.flushing.append(keys)
+            try:
+                await asyncio.to_thread(self.write, rows, deleted)
+            except sqlite3.Error as e:
+                self.logger.error(f"Failed to save {len(rows)} setups: {e}")
+                self.dirty.update(keys)
+            finally:
+                self.flushing.remove(keys)
+
+    def flush_now(self, setups):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        rows, deleted = self.take_dirty(setups)
+        if rows or deleted:
+            self.write(rows, deleted)
+
+    def close(self, setups):
+        self.flush_now(setups)
+        self.conn.close()
+
+class MessageSpool:
+    # append-only log of accepted messages: an "add" record when a message is taken,
+    # an "ack" once it has been delivered; whatever is unacked on startup is replayed
+    def __init__(self, path=SPOOL_FILE, max_entries=SPOOL_MAX_ENTRIES, max_age=SPOOL_MAX_AGE, max_attempts=SPOOL_MAX_ATTEMPTS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.entries = OrderedDict()
+        self.inflight = set()
+        self.attempts = {}
+        self.ids = itertools.count(1)
+        self.acked = 0
+        self.dropped = 0
+        self.file = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                for record in msgpack.Unpacker(f, raw=False):
+                    if record.get("op") == "add":
+                        self.entries[record["id"]] = (record["at"], record["job"])
+                    else:
+                        self.entries.pop(record.get("id"), None)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # a crash mid-write leaves a torn last record, keep what came before it
+            self.logger.warning(f"Spool {self.path} ends early: {e}")
+        self.ids = itertools.count(max(self.entries, default=0) + 1)
+        self.prune()
+        self.compact()
+        if self.entries:
+            self.logger.info(f"Replaying {len(self.entries)} spooled messages from {self.path}")
+
+    def record(self, record):
+        self.file.write(msgpack.packb(record))
+        self.file.flush()
+
+    def append(self, job):
+        entry_id = next(self.ids)
+        at = time.time()
+        self.record({"op": "add", "id": entry_id, "at": at, "job": job})
+        self.entries[entry_id] = (at, job)
+        if len(self.entries) > self.max_entries:
+            oldest = next((key for key in self.entries if key not in self.inflight), None)
+            if oldest is not None:
+                self.logger.warning(f"Spool full, dropping message {oldest}")
+                self.drop(oldest)
+        return entry_id
+
+    def take(self, busy=()):
+        for entry_id, (_, job) in self.entries.items():
+            if entry_id not in self.inflight and job["key"] not in busy:
+                self.inflight.add(entry_id)
+                return entry_id, job
+        return None
+
+    def track(self, entry_id, future):
+        if future is None:
+            self.inflight.discard(entry_id)
+            return
+        self.inflight.add(entry_id)
+        future.add_done_callback(partial(self.settle, entry_id))
+
+    def settle(self, entry_id, future):
+        if future.cancelled():
+            # shed by the scheduler, which says nothing about the message itself
+            self.release(entry_id, failed=False)
+        elif future.result():
+            self.ack(entry_id)
+        else:
+            self.release(entry_id)
+
+    def release(self, entry_id, failed=True):
+        self.inflight.discard(entry_id)
+        if entry_id not in self.entries or not failed:
+            return
+        self.attempts[entry_id] = self.attempts.get(entry_id, 0) + 1
+        if self.attempts[entry_id] >= self.max_attempts:
+            self.logger.warning(f"Giving up on spooled message {entry_id} after {self.attempts[entry_id]} attempts")
+            self.drop(entry_id)
+
+    def ack(self, entry_id):
+        self.inflight.discard(entry_id)
+        self.attempts.pop(entry_id, None)
+        if self.entries.pop(entry_id, None) is None:
+            return
+        self.record({"op": "ack", "id": entry_id})
+        self.acked += 1
+        # rewrite once the log is mostly acknowledged records
+        if self.acked >= 1000 and self.acked > 4 * len(self.entries):
+            self.compact()
+
+    def drop(self, entry_id):
+        self.dropped += 1
+        self.ack(entry_id)
+
+    def prune(self):
+        cutoff = time.time() - self.max_age
+        expired = [entry_id for entry_id, (at, _) in self.entries.items() if at < cutoff and entry_id not in self.inflight]
+        for entry_id in expired:
+            self.dropped += 1
+            self.entries.pop(entry_id)
+            self.attempts.pop(entry_id, None)
+        if expired:
+            self.logger.warning(f"Dropped {len(expired)} spooled messages older than {self.max_age}s")
+        return len(expired)
+
+    def compact(self):
+        if self.file is not None:
+            self.file.close()
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, "wb") as f:
+            for entry_id, (at, job) in self.entries.items():
+                f.write(msgpack.packb({"op": "add", "id": entry_id, "at": at, "job": job}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path)
+        self.file = open(self.path, "ab")
+        self.acked = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class WebhookDirectory:
+    def __init__(self, name=WEBHOOK_NAME, ttl=WEBHOOK_DIRECTORY_TTL):
+        self.name = name
+        self.ttl = ttl
+        # guild id -> (fetched at, {channel id: webhook}), filled from one
+        # guild.webhooks() call instead of listing every channel separately
+        self.guilds = {}
+        self.locks = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    async def guild_webhooks(self, guild):
+        cached = self.guilds.get(guild.id)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        async with self.locks.setdefault(guild.id, asyncio.Lock()):
+            cached = self.guilds.get(guild.id)
+            if cached is not None and time.monotonic() - cached[0] < self.ttl:
+                return cached[1]
+            webhooks = {}
+            for webhook in await guild.webhooks():
+                if webhook.name == self.name and webhook.token and webhook.channel_id not in webhooks:
+                    webhooks[webhook.channel_id] = webhook
+            self.guilds[guild.id] = (time.monotonic(), webhooks)
+            return webhooks
+
+    async def get_or_create(self, channel, verify=False):
+        guild = getattr(channel, 'guild', None)
+        webhooks = None
+        if guild is not None:
+            try:
+                webhooks = await self.guild_webhooks(guild)
+            except discord.Forbidden:
+                self.logger.debug(f"No guild wide webhook access in {guild.id}, listing channel {channel.id}")
+        if webhooks is None:
+            for webhook in await channel.webhooks():
+                if webhook.name == self.name:
+                    return webhook
+            return await channel.create_webhook(name=self.name)
+        webhook = webhooks.get(channel.id)
+        if webhook is None and verify:
+            # another process may have made one since the listing was cached, look
+            # again before creating a duplicate
+            self.invalidate(guild.id)
+            return await self.get_or_create(channel)
+        if webhook is None:
+            webhook = await channel.create_webhook(name=self.name)
+            webhooks[channel.id] = webhook
+        elif verify:
+            try:
+                await webhook.fetch()
+            except discord.NotFound:
+                # deleted since the listing was cached, list the guild again
+                self.invalidate(guild.id)
+                return await self.get_or_create(channel)
+        return webhook
+
+    def invalidate(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+class GuildQueue:
+    def __init__(self, weight=1):
+        self.setups = OrderedDict()
+        self.size = 0
+        self.weight = weight
+        self.credits = weight
+
+    def push(self, setup_key, entry):
+        self.setups.setdefault(setup_key, deque()).append(entry)
+        self.size += 1
+
+    def pop(self):
+        # round robin over the guild's setups
+        setup_key, queue = next(iter(self.setups.items()))
+        entry = queue.popleft()
+        self.size -= 1
+        del self.setups[setup_key]
+        if queue:
+            self.setups[setup_key] = queue
+        return entry
+
+    def drop_oldest(self, setup_key=None):
+        if setup_key not in self.setups:
+            setup_key = max(self.setups, key=lambda k: len(self.setups[k]))
+        queue = self.setups[setup_key]
+        entry = queue.popleft()
+        self.size -= 1
+        if not queue:
+            del self.setups[setup_key]
+        return entry
+
+class FairScheduler:
+    def __init__(self, workers=SCHEDULER_WORKERS, guild_depth=SCHEDULER_GUILD_DEPTH, setup_depth=SCHEDULER_SETUP_DEPTH, policy=SCHEDULER_POLICY, weights=SCHEDULER_GUILD_WEIGHTS, guild_running=SCHEDULER_GUILD_RUNNING):
+        self.worker_count = workers
+        self.guild_running = guild_running
+        # guild id -> jobs running; a guild stuck behind a rate limited webhook
+        # can only put this many workers to sleep on it
+        self.running_by_guild = {}
+        self.guild_depth = guild_depth
+        self.setup_depth = setup_depth
+        self.policy = policy
+        self.weights = weights
+        # one guild -> GuildQueue table per priority, lower index served first
+        self.levels = tuple(OrderedDict() for _ in range(PRIORITY_PASSIVE + 1))
+        self.wakeup = asyncio.Event()
+        self.workers = []
+        self.pending = 0
+        self.running = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def start(self, loop):
+        if not self.workers:
+            self.workers = [loop.create_task(self.worker()) for _ in range(self.worker_count)]
+
+    def submit(self, guild_id, setup_key, job, priority=PRIORITY_PASSIVE):
+        guilds = self.levels[priority]
+        guild = guilds.get(guild_id)
+        if guild is None:
+            guild = guilds[guild_id] = GuildQueue(self.weights.get(guild_id, 1))
+        setup_queue = guild.setups.get(setup_key)
+        setup_full = setup_queue is not None and len(setup_queue) >= self.setup_depth
+        if setup_full or guild.size >= self.guild_depth:
+            if self.policy == "reject":
+                self.rejected += 1
+                self.logger.warning(f"Queue full for guild {guild_id}, rejecting work for {setup_key}")
+                return None
+            _, dropped = guild.drop_oldest(setup_key if setup_full else None)
+            dropped.cancel()
+            self.pending -= 1
+            self.dropped += 1
+        future = asyncio.get_running_loop().create_future()
+        guild.push(setup_key, (job, future))
+        self.pending += 1
+        self.wakeup.set()
+        return future
+
+    def next_entry(self):
+        for guilds in self.levels:
+            guild_id = next((guild_id for guild_id in guilds if self.running_by_guild.get(guild_id, 0) < self.guild_running), None)
+            if guild_id is None:
+                continue
+            guild = guilds[guild_id]
+            entry = guild.pop()
+            guild.credits -= 1
+            if not guild.size:
+                del guilds[guild_id]
+            elif guild.credits <= 0:
+                guild.credits = guild.weight
+                guilds.move_to_end(guild_id)
+            self.pending -= 1
+            return guild_id, entry
+        return None
+
+    async def worker(self):
+        while True:
+            entry = self.next_entry()
+            if entry is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            guild_id, (job, future) = entry
+            if future.cancelled():
+                continue
+            self.running += 1
+            self.running_by_guild[guild_id] = self.running_by_guild.get(guild_id, 0) + 1
+            try:
+                result = await job()
+            except Exception:
                 self.logger.error(traceback.format_exc())
-                self.logger.error(f"Failed heartbeat for {self.layer_name}")
-                self.reconnect_socket()
+                result = None
+            finally:
+                self.running -= 1
+                self.running_by_guild[guild_id] -= 1
+                if not self.running_by_guild[guild_id]:
+                    del self.running_by_guild[guild_id]
+                # work held back for this guild can go now
+                self.wakeup.set()
+            if not future.done():
+                future.set_result(result)
+
+class RelayedMessage:
+    # what translation and delivery read off a discord.Message, rebuilt on the worker
+    def __init__(self, data):
+        self.id = data["id"]
+        self.content = data["content"]
+        self.channel = discord.Object(data["channel_id"])
+        self.guild = discord.Object(data["guild_id"]) if data.get("guild_id") else None
+
+def parse_shard_ids(spec):
+    # "0-3" or "0,2,5"
+    ids = []
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        ids.extend(range(int(first), int(last or first) + 1))
+    return ids
 
-class Translatiob(commands.Bot):
-    def __init__(self,top_layer_port):
+class Translatiob(commands.AutoShardedBot):
+    def __init__(self,top_layer_port, shard_ids=None):
         intents = discord.Intents.default()
         intents.typing = True
         intents.messages = True
         intents.message_content = True
         intents.members = True
-        super().__init__(command_prefix='!', intents=intents)  # Use '!' as command prefix
+        super().__init__(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=shard_ids)  # Use '!' as command prefix
         self.temp = 2.2  # Default temperature
+        self.profiles = {}
         self.models = []
         self.models_decice = []
         self.llmcfg = {
@@ -102,32 +1594,361 @@ class Translatiob(commands.Bot):
             "skip_special_tokens_out": True
         }
         
-        self.LLM = ZMQClient(port=top_layer_port, layer_name="LLM", timeout=TIMEOUT)
-        self.nick_cache = {}
-        self._blocked = False
-        self.setups = self.load_setups()  # Load existing setups from JSON
+        self.LLM = BackendRouter(LLM_BACKENDS or [f"tcp://127.0.0.1:{top_layer_port}"])
+        self.LLM.on_refresh = self.probe_capabilities
+        # set on shard processes, which hand generation and delivery to the worker
+        self.worker = None
+        # opened by whichever process generates, see start_generation
+        self.spool = None
+        self.started = False
+        # shard processes share a host with the worker, so each serves metrics on
+        # its own port past the worker's: METRICS_PORT + 1 + first shard id
+        self.metrics_port = METRICS_PORT + 1 + shard_ids[0] if METRICS_PORT and shard_ids else METRICS_PORT
+        self.batcher = GenBatcher(self.LLM)
+        self.webhooks = WebhookDispatcher()
+        self.webhook_directory = WebhookDirectory()
+        self.scheduler = FairScheduler()
+        self.deleter = MessageDeleter()
+        self.tracer = Tracer()
+        self.register_metrics()
+        self.translation_cache = TTLCache(TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL)
+        # outputs sampled above TRANSLATION_CACHE_MAX_TEMPERATURE only absorb bursts
+        # of the same text, so repeats later on still come out different
+        self.sampled_cache = TTLCache(TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_SAMPLED_TTL) if TRANSLATION_CACHE_SAMPLED_TTL else None
+        self.singleflight = SingleFlight()
+        self.capabilities = set()
+        self.nick_cache = TTLCache(NICK_CACHE_SIZE, NICK_CACHE_TTL)
+        self.load_nick_cache()
+        self.setup_store = SetupStore()
+        self.setups = self.load_setups()  # Load existing setups from the store
+        self.setup_index = SetupIndex(self.setups)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.cache = {}
         
+    def register_metrics(self):
+        METRICS.register(Gauge("translatiob_pending_translations", "Translations queued or running", ("state",),
+                               fn=lambda: {("queued",): self.scheduler.pending, ("running",): self.scheduler.running}))
+        METRICS.register(Gauge("translatiob_scheduler_shed_total", "Translations dropped or rejected by the scheduler", ("reason",),
+                               fn=lambda: {("dropped",): self.scheduler.dropped, ("rejected",): self.scheduler.rejected}, kind="counter"))
+        METRICS.register(Gauge("translatiob_cache_entries", "Entries in the nick and translation caches", ("cache",),
+                               fn=lambda: {("nick",): len(self.nick_cache), ("translation",): len(self.translation_cache),
+                                           **({("sampled",): len(self.sampled_cache)} if self.sampled_cache else {})}))
+        METRICS.register(Gauge("translatiob_cache_lookups_total", "Cache lookups by result", ("cache", "result"),
+                               fn=lambda: {("nick", "hit"): self.nick_cache.hits, ("nick", "miss"): self.nick_cache.misses,
+                                           ("translation", "hit"): self.translation_cache.hits, ("translation", "miss"): self.translation_cache.misses,
+                                           **({("sampled", "hit"): self.sampled_cache.hits, ("sampled", "miss"): self.sampled_cache.misses} if self.sampled_cache else {})}, kind="counter"))
+        METRICS.register(Gauge("translatiob_singleflight_shared_total", "Generation calls that joined an identical in-flight request", (),
+                               fn=lambda: {(): self.singleflight.shared}, kind="counter"))
+        METRICS.register(Gauge("translatiob_spool_entries", "Accepted messages not yet delivered", ("state",),
+                               fn=lambda: {("queued",): len(self.spool.entries) - len(self.spool.inflight), ("inflight",): len(self.spool.inflight)} if self.spool else {}))
+        METRICS.register(Gauge("translatiob_spool_dropped_total", "Spooled messages given up on", (),
+                               fn=lambda: {(): self.spool.dropped} if self.spool else {}, kind="counter"))
+        METRICS.register(Gauge("translatiob_llm_backend_up", "1 while the backend circuit breaker is closed", ("backend",),
+                               fn=lambda: {(b.endpoint,): int(b.is_available) for b in self.LLM.backends}))
+        METRICS.register(Gauge("translatiob_llm_backend_latency_seconds", "Smoothed probe and request latency the circuit breaker sees", ("backend",),
+                               fn=lambda: {(b.endpoint,): b.breaker.latency for b in self.LLM.backends if b.breaker.latency is not None}))
+
     async def on_ready(self):
-        self.logger.info(f'Logged in as {self.user}')
-        await self.LLM.start(self.loop)
-        self.models = self.LLM.safe_send({"from": "translatiob", "type": "get_models"})
+        self.logger.info(f'Logged in as {self.user} (shards {self.shard_ids or "all"} of {self.shard_count})')
+        # on_ready fires again after every new gateway session, start everything once
+        if self.started:
+            return
+        self.started = True
+        await self.serve_metrics()
+        if self.worker is not None:
+            await self.worker.start(self.loop)
+            models = await self.worker.safe_send({"from": "translatiob", "type": "get_models"})
+            self.models = models if isinstance(models, list) else []
+        else:
+            await self.start_generation()
+            self.clear_names.start()
         for i in self.models:
             self.models_decice.append(app_commands.Choice(name=i, value=i))
-        self.clear_names.start()
+        self.sync_setups.start()
         await self.tree.sync()
+
+    async def serve_metrics(self):
+        if not self.metrics_port:
+            return
+        try:
+            await METRICS.serve(METRICS_HOST, self.metrics_port)
+        except OSError as e:
+            # metrics are not worth failing startup over
+            self.logger.error(f"Could not serve metrics on {METRICS_HOST}:{self.metrics_port}: {e}")
+
+    async def start_generation(self):
+        # the worker never logs in, so self.loop isn't there to use
+        loop = asyncio.get_running_loop()
+        await self.LLM.start(loop)
+        self.scheduler.start(loop)
+        self.models = await self.LLM.refresh()
+        self.probe_capabilities()
+        if SPOOL_FILE:
+            # messages arriving during the load would append to a spool with no file
+            # open yet, only hand it out once it's ready
+            spool = MessageSpool()
+            await asyncio.to_thread(spool.load)
+            self.spool = spool
+            loop.create_task(self.drain_spool())
+
+    def accept(self, guild_id, key, message, author, avatar, setups, trace=None):
+        entry_id = None
+        if self.spool is not None:
+            entry_id = self.spool.append(self.message_payload(guild_id, key, message, author, avatar, setups))
+            if not self.LLM.is_available:
+                # kept on disk, drain_spool sends it once the backend is back
+                self.spool.track(entry_id, None)
+                return None
+        job = self.scheduler.submit(guild_id, key, partial(self._on_message, message, author, avatar, setups, trace, time.perf_counter()))
+        if entry_id is not None:
+            self.spool.track(entry_id, job)
+        return job
+
+    async def drain_spool(self):
+        draining = False
+        # drained jobs in flight, overall and per setup key; the per key cap stays
+        # under SCHEDULER_SETUP_DEPTH so drop_oldest never sheds our own submissions
+        slots = asyncio.Semaphore(SPOOL_DRAIN_BACKLOG)
+        drained = {}
+        freed = asyncio.Event()
+
+        def done(key, _):
+            slots.release()
+            drained[key] -= 1
+            if not drained[key]:
+                del drained[key]
+            freed.set()
+
+        while True:
+            if not self.LLM.is_available or self.scheduler.pending >= SPOOL_DRAIN_BACKLOG:
+                draining = False
+                self.spool.prune()
+                await asyncio.sleep(1)
+                continue
+            if not draining:
+                # spread out resumes so a recovered backend doesn't get every backlog at once
+                draining = True
+                await asyncio.sleep(random.uniform(0, SPOOL_DRAIN_JITTER))
+                continue
+            await slots.acquire()
+            entry = self.spool.take({key for key, count in drained.items() if count >= SPOOL_DRAIN_PER_SETUP})
+            if entry is None:
+                slots.release()
+                self.spool.prune()
+                # nothing left, or only keys already at their cap: wait for one to finish
+                freed.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(freed.wait(), 1)
+                continue
+            entry_id, job = entry
+            key = job["key"]
+            future = self.scheduler.submit(job["guild_id"], key, partial(self._on_message, RelayedMessage(job["message"]), job["author"], job["avatar"], job["setups"]))
+            self.spool.track(entry_id, future)
+            if future is None:
+                # rejected, give the scheduler room instead of retrying the same entry at once
+                slots.release()
+                await asyncio.sleep(1)
+                continue
+            drained[key] = drained.get(key, 0) + 1
+            future.add_done_callback(partial(done, key))
+            await asyncio.sleep(0)
+
+    def use_worker(self, endpoint):
+        self.worker = ZMQClient(endpoint, layer_name=f"worker[{endpoint}]", timeout=TIMEOUT)
+
+    @property
+    def backend_available(self):
+        return (self.worker or self.LLM).is_available
+
+    async def serve_worker(self, endpoint=WORKER_ENDPOINT):
+        # the generation/delivery process: owns the backend pool, the caches and the
+        # webhook sessions, and takes work from the shard processes over local IPC
+        await self.serve_metrics()
+        await self.start_generation()
+        self.clear_names.start()
+        socket = zmq.asyncio.Context.instance().socket(zmq.ROUTER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.bind(endpoint)
+        self.logger.info(f"Worker listening on {endpoint}")
+        try:
+            while True:
+                frames = await socket.recv_multipart()
+                asyncio.get_running_loop().create_task(self.handle_relay(socket, frames[:-1], msgpack.unpackb(frames[-1])))
+        finally:
+            socket.close(linger=0)
+            await self.shutdown()
+
+    async def handle_relay(self, socket, envelope, request):
+        kind = request.get("type")
+        if kind == "ping":
+            reply = "pong"
+        elif kind == "translate":
+            job = self.accept(request.get("guild_id"), request["key"], RelayedMessage(request["message"]), request["author"], request["avatar"], request["setups"])
+            reply = {"queued": job is not None or self.spool is not None}
+        elif kind == "chain":
+            responses = await self.interactive_chain(request.get("guild_id"), request["key"], request["text"], request["model"], request["depth"], request.get("deadline"))
+            reply = responses if responses is not None else {"busy": True}
+        elif kind == "cfg":
+            self.llmcfg.update(request["llmcfg"])
+            self.profiles.clear()
+            reply = "ok"
+        elif kind == "nick":
+            reply = await self.translate_nick(request["author"], request["model"])
+        elif kind == "get_models":
+            reply = self.models
+        elif kind == "cache_stats":
+            reply = await self.cache_stats()
+        else:
+            reply = {"error": f"unknown type {kind}"}
+        await socket.send_multipart(envelope + [msgpack.packb(reply)])
+
+    def message_payload(self, guild_id, key, message, author, avatar, setups):
+        return {
+            "key": key,
+            "guild_id": guild_id,
+            "message": {"id": message.id, "content": message.content, "channel_id": message.channel.id, "guild_id": guild_id},
+            "author": author,
+            "avatar": avatar,
+            "setups": setups,
+        }
+
+    async def relay(self, message, author, avatar, setups, key):
+        guild_id = message.guild.id if message.guild else None
+        reply = await self.worker.safe_send({"from": "translatiob", "type": "translate", **self.message_payload(guild_id, key, message, author, avatar, setups)})
+        if not isinstance(reply, dict) or not reply.get("queued"):
+            self.logger.warning(f"Worker did not take message {message.id}: {reply}")
+            return False
+        return True
+
+    async def interactive_chain(self, guild_id, key, text, model, depth, deadline=None):
+        # None when the scheduler turned it away, [] when generation failed
+        if self.worker is not None:
+            with deadline_scope(deadline):
+                reply = await self.worker.safe_send({"from": "translatiob", "type": "chain", "guild_id": guild_id, "key": key, "text": text, "model": model, "depth": depth})
+            if isinstance(reply, dict) and reply.get("busy"):
+                return None
+            return reply if isinstance(reply, list) else []
+        job = self.scheduler.submit(guild_id, key, partial(within_deadline, deadline, self.generate_chain, text, model, depth), priority=PRIORITY_INTERACTIVE)
+        if job is not None:
+            await asyncio.wait([job])
+        if job is None or job.cancelled():
+            return None
+        return job.result() or []
+
+    async def translate_nick(self, author, model):
+        if self.worker is not None:
+            reply = await self.worker.safe_send({"from": "translatiob", "type": "nick", "author": author, "model": model})
+            return reply if isinstance(reply, str) else author
+        return await self.translate_author(author, model)
+
+    async def cache_stats(self):
+        if self.worker is not None:
+            return await self.worker.safe_send({"from": "translatiob", "type": "cache_stats"})
+        cache = self.generation_cache()
+        if cache is None:
+            return {"bypassed": True}
+        return {"size": len(cache), "max_size": cache.max_size, "hits": cache.hits, "misses": cache.misses, "hit_rate": cache.hit_rate(),
+                "bypassed": False, "sampled_ttl": cache.ttl if cache is self.sampled_cache else None}
+
+    @tasks.loop(seconds=SETUP_SYNC_INTERVAL)
+    async def sync_setups(self):
+        # other shards write to the same store, pick up what they changed
+        if not await asyncio.to_thread(self.setup_store.changed):
+            return
+        # a flush that commits while rows are read is in neither, so take what
+        # was pending before the read as well as after
+        pending = self.setup_store.pending
+        fresh = await asyncio.to_thread(self.setup_store.rows)
+        pending |= self.setup_store.pending
+        for key in [key for key in self.setups if key not in fresh and key not in pending]:
+            del self.setups[key]
+            self.setup_index.remove(key)
+        for key, setup in fresh.items():
+            if key not in pending and self.setups.get(key) != setup:
+                self.put_setup(key, setup)
         
 
+    def probe_capabilities(self):
+        capabilities = self.LLM.capabilities()
+        if capabilities != self.capabilities:
+            self.logger.info(f"Backend capabilities: {sorted(capabilities) or 'none'}")
+        self.capabilities = capabilities
+        self.batcher.enabled = "gen_batch" in self.capabilities
+
+    async def generate_chain(self, text, model, depth):
+        depth = min(MAX_RECURSION_DEPTH, max(0, depth))
+        if depth > 0 and "chain" in self.capabilities and len(text) <= CHUNK_MAX_CHARS:
+            request = dict(self.get_config(text, model), type="chain", depth=depth, stop_on_repeat=True)
+            with trace_span(f"llm chain[{depth}]"):
+                key = ("chain", text, model, depth, self.profile(model).key)
+                outputs = await self.singleflight.do(key, partial(self.LLM.safe_send, request))
+            if isinstance(outputs, list) and outputs:
+                return outputs
+            self.logger.warning(f"Bad chain reply for {model}, falling back to step by step")
+        outputs = []
+        current = text
+        for i in range(depth + 1):
+            with trace_span(f"llm gen[{i}]"):
+                output = await self.generate_long(current, model)
+            # nothing more to wobble once a step fails or settles on itself
+            if not output or (outputs and output == current):
+                break
+            outputs.append(output)
+            current = output
+        return outputs
+
+    def sampled(self):
+        if TRANSLATION_CACHE_MAX_TEMPERATURE is None:
+            return False
+        # both blocks go out with every request and the backend samples with one
+        # of them, so judge by the hotter; /cfg can move the config one
+        temperatures = [t for t in (self.llmcfg.get("temperature"), self.temp) if t is not None]
+        return bool(temperatures) and max(temperatures) > TRANSLATION_CACHE_MAX_TEMPERATURE
+
+    def generation_cache(self):
+        # None when sampled output isn't kept at all
+        return self.sampled_cache if self.sampled() else self.translation_cache
+
+    async def generate_long(self, text, model):
+        if len(text) <= CHUNK_MAX_CHARS:
+            return await self.generate(text, model)
+        # the backend stops at max_new_tokens, so long text goes out in pieces;
+        # issued together they land in the same gen_batch
+        chunks = split_text(text.strip(), CHUNK_MAX_CHARS)
+        with trace_span(f"chunks[{len(chunks)}]"):
+            outputs = await asyncio.gather(*(self.generate(chunk.strip(), model) for chunk in chunks if chunk.strip()))
+        if not all(outputs):
+            return None
+        # put back the line breaks and spaces the text was cut at
+        outputs = iter(outputs)
+        return "".join((next(outputs) if chunk.strip() else "") + chunk[len(chunk.rstrip()):] for chunk in chunks).strip()
+
+    async def generate(self, text, model):
+        key = (text, model, self.profile(model).key)
+        cache = self.generation_cache()
+        if cache is not None:
+            response = cache.get(key)
+            if response is not None:
+                return response
+        # identical requests already in flight share one backend call, whether or
+        # not the result may be kept afterwards
+        return await self.singleflight.do(key, partial(self.fetch_generation, key, text, model))
+
+    async def fetch_generation(self, key, text, model):
+        response = await self.batcher.send(self.get_config(text, model))
+        cache = self.generation_cache()
+        if response and cache is not None:
+            cache.set(key, response)
+        return response
+
     def can_delete(self, message, key):
         if key in self.setups and self.setups[key].get("delete_messages", False) and not self.setups[key].get("disabled", False):
             if not message.webhook_id:
                 self.logger.info("MNONE WEGBHOKKER")
                 return 1
-            else:              
-                for k,v in self.setups.items():
-                    if v['webhook_id'] == message.webhook_id:
-                        return -1
+            elif self.setup_index.is_own_webhook(message.webhook_id, enabled_only=False):
+                return -1
+            else:
                 return 1
         return 0
     
@@ -151,16 +1972,17 @@ class Translatiob(commands.Bot):
             avatar = random.choice(["https://i.imgur.com/NGvttCc.gif", "https://i.imgur.com/SMJq55x.gif", "https://i.imgur.com/3pgztqw.gif", "https://i.imgur.com/WLoxslE.gif"])
         return avatar
     
-    def translate_author(self, author, model):
-        self.logger.debug(f"{author}, {self.nick_cache}")
+    async def translate_author(self, author, model):
+        cached = self.nick_cache.get((author, model))
+        if cached is not None:
+            return cached
+        self.logger.debug(f"Nick cache miss for {author} ({model})")
         try:
-            if author not in self.nick_cache:
-                author_ = self.LLM.safe_send(bot.get_config(author, model))
-                if author_:
-                    self.nick_cache[author] = author_
-                    author = author_
-            else:
-                author = self.nick_cache[author]
+            with trace_span("translate_author"):
+                author_ = await self.generate(author, model)
+            if author_:
+                self.nick_cache.set((author, model), author_)
+                author = author_
         except Exception as e:
             self.logger.error(f"HUBINTA {e}")
         return author
@@ -171,22 +1993,18 @@ class Translatiob(commands.Bot):
             return  # Ignore messages from the bot itself or if the message is None
         
         #content = message.content
+        trace = self.tracer.start(f"message {message.id}")
+        route_started = time.perf_counter()
         author = self.get_author(message)
         avatar = self.get_avatar(message)
         
-        is_from_self = False
-        relevant_keys = []
-        for i in self.setups.values():
-            if i['from_channel'] == message.channel.id and not i['disabled']:
-                relevant_keys.append(i)
-            elif i['from_server'] == message.guild.id and not i['disabled']:
-                relevant_keys.append(i)
-            elif i['from_author'] == message.author.id and not i['disabled']:
-                relevant_keys.append(i)
-            if i['webhook_id'] == message.webhook_id and not i['disabled']:
-                is_from_self = True
-        if is_from_self:
+        if self.setup_index.is_own_webhook(message.webhook_id):
+            self.tracer.release(trace)
             return
+        guild_id = message.guild.id if message.guild else None
+        relevant_keys = self.setup_index.match(message.channel.id, guild_id, message.author.id)
+        if trace is not None:
+            trace.record("route", route_started, time.perf_counter())
         
             
         #if message.channel.id in self.cache:
@@ -194,20 +2012,44 @@ class Translatiob(commands.Bot):
         #else:
         #    self.cache[message.channel.id] = set(relevant_keys)
         
+        # setups sharing a model and depth would produce the same chain, so
+        # generate it once per group and fan it out to each destination
+        groups = {}
+        delete = False
         for key in relevant_keys:
-            if key['delete_messages']:
-                try:
-                    await message.delete()
-                except:
-                    print("NOT DELTE CONE")
-            asyncio.create_task(self._on_message(message, author, avatar, key))
+            setup = self.setups[key]
+            delete = delete or setup['delete_messages']
+            groups.setdefault((setup['model'], setup['recursion_depth']), []).append((key, setup))
+        relayed = True
+        for group in groups.values():
+            setups = [setup for _, setup in group]
+            if self.worker is not None:
+                relayed = await self.relay(message, author, avatar, setups, group[0][0]) and relayed
+                continue
+            job = self.accept(guild_id, group[0][0], message, author, avatar, setups, trace)
+            if trace is not None and job is not None:
+                # the trace is finished once every job it spawned is done or dropped
+                self.tracer.acquire(trace)
+                job.add_done_callback(lambda _, trace=trace: self.tracer.release(trace))
+        # a message the worker never took stays up rather than vanishing untranslated
+        if delete and relayed:
+            # batched per channel in the background, translation doesn't wait on it
+            self.deleter.submit(message)
+        self.tracer.release(trace)
 
     def get_config(self, text, model):
+        return {"type": "gen", "text": text, "model": model, "profile": self.profile(model)}
+
+    def profile(self, model):
+        profile = self.profiles.get(model)
+        if profile is None:
+            profile = self.profiles[model] = GenProfile(self.profile_fields(model))
+        return profile
+
+    def profile_fields(self, model):
         return ({
-            "type": "gen",
-            "text": text,
             "model": model,
-            "config": self.llmcfg,
+            "config": dict(self.llmcfg),
             "XDEAR":{
                 "temperature": self.temp,
                 'max_new_tokens': 256,
@@ -219,43 +2061,137 @@ class Translatiob(commands.Bot):
             "from": "translatiob"
         })
 
-    async def _on_message(self, message, author, avatar, setup):
-        if not self.LLM.is_available or message.content is None:
-            return
-        self._blocked = True
+    async def _on_message(self, message, author, avatar, setups, trace=None, queued_at=None):
+        # the budget starts once a worker picks the message up and grows with the chain
+        deadline = time.time() + MESSAGE_BUDGET * (setups[0]['recursion_depth'] + 1) if setups else None
+        with deadline_scope(deadline):
+            if trace is None:
+                return await self.translate_message(message, author, avatar, setups)
+            trace.record("queued", queued_at, time.perf_counter())
+            token = CURRENT_TRACE.set(trace)
+            try:
+                return await self.translate_message(message, author, avatar, setups)
+            finally:
+                CURRENT_TRACE.reset(token)
+
+    async def translate_message(self, message, author, avatar, setups):
+        # True once every post went out, spooled messages are kept until then
+        if not self.LLM.is_available:
+            return False
+        if message.content is None or not setups:
+            return True
         self.logger.debug(message.content)
-        if setup:
-            response = self.LLM.safe_send(self.get_config(message.content, model = setup['model']))
-            responses = [response]
-            current_woble = response
-            self.logger.warning(f"{author}: {message.content} -> {response}")
-            if True:
-                for i in range(setup['recursion_depth']):
-                    old_wobble = current_woble
-                    current_woble = self.LLM.safe_send(self.get_config(old_wobble, model = setup['model']))
-                    self.logger.warning(f"{author}: {old_wobble} -> {current_woble}")
-                    if current_woble:
-                        responses.append(current_woble)
-            print(responses)
-            author = self.translate_author(author, setup['model'])
+        # every setup in the group shares the model and depth
+        setup = setups[0]
+        streamed = None
+        if len(setups) == 1 and setup.get("delivery") == "stream" and "gen_stream" in self.capabilities and len(message.content) <= CHUNK_MAX_CHARS:
+            author = await self.translate_author(author, setup['model'])
+            with trace_span("stream"):
+                streamed = await self.stream_response(message, author, setup, avatar)
+            if streamed is False:
+                # a partial post went out and nothing could complete it
+                return False
+        if streamed:
+            responses = [streamed]
+            if setup['recursion_depth'] > 0:
+                responses += await self.generate_chain(streamed, setup['model'], setup['recursion_depth'] - 1)
+        else:
+            responses = await self.generate_chain(message.content, setup['model'], setup['recursion_depth'])
+        CHAIN_LENGTH.observe(len(responses))
+        for old_wobble, current_woble in zip([message.content] + responses, responses):
+            self.logger.warning(f"{author}: {old_wobble} -> {current_woble}")
+        if not responses:
+            return False
+        if streamed:
+            # the first output already went out while it was generating
+            delivered = [await self.deliver_responses(message, responses[1:], author, setup, avatar)]
+        else:
+            author = await self.translate_author(author, setup['model'])
             # Forward the response via webhook
-            for resp in responses:
-                _, sent = await self.send_webhook(message, resp, author, setup, avatar)
-            self._blocked = False
+            delivered = await asyncio.gather(*(self.deliver_responses(message, responses, author, destination, avatar) for destination in setups))
+        return all(result is not None and result[0].ok for results in delivered for result in results)
             
+    async def deliver_responses(self, message, responses, author, setup, avatar):
+        # reassembled translations can outgrow a single post; leave room for
+        # the jump link send_webhook appends to mirrored posts
+        responses = [chunk.strip() for r in responses if r for chunk in split_text(str(r), 1900) if chunk.strip()]
+        if setup.get("delivery", "each") == "packed":
+            responses = chunk_lines(responses, limit=1900)
+        results = []
+        for resp in responses:
+            results.append(await self.send_webhook(message, resp, author, setup, avatar))
+        return results
+
+    async def stream_response(self, message, author, setup, avatar):
+        text = ""
+        posted_id = None
+        last_edit = 0
+        edit_task = None
+        finished = False
+        request = dict(self.get_config(message.content, setup['model']), type="gen_stream")
+        async with contextlib.aclosing(self.LLM.stream(request)) as parts:
+            async for part in parts:
+                if not isinstance(part, dict):
+                    break
+                text += part.get("chunk") or ""
+                finished = bool(part.get("done"))
+                if not text.strip():
+                    continue
+                if posted_id is None:
+                    result, _ = await self.send_webhook(message, text, author, setup, avatar)
+                    if not result.ok or not isinstance(result.data, dict):
+                        return None
+                    posted_id = result.data.get("id")
+                    last_edit = time.monotonic()
+                elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL and (edit_task is None or edit_task.done()):
+                    edit_task = asyncio.create_task(self.edit_webhook(message, posted_id, text, setup))
+                    last_edit = time.monotonic()
+        if posted_id is None:
+            return None
+        if edit_task is not None:
+            await edit_task
+        if not finished:
+            # cut off by a timeout, a reconnect or the deadline, so the text is only
+            # a prefix; generate it whole and put that over the partial post
+            self.logger.warning(f"Stream for message {message.id} ended early, generating it whole")
+            text = await self.generate_long(message.content, setup['model'])
+            if not text:
+                return False
+        await self.edit_webhook(message, posted_id, text, setup)
+        return text
+
+    async def edit_webhook(self, message, message_id, response, setup):
+        result = await self.webhooks.edit(setup["webhook_id"], setup["webhook_token"], message_id, {"content": self.webhook_content(message, response, setup)})
+        if not result.ok:
+            self.logger.error(f"Webhook {setup['webhook_id']} edit failed: {result.status} {result.error or result.data}")
+            self.forget_webhook(message, setup, result.status)
+        return result
+
+    def forget_webhook(self, message, setup, status):
+        # the webhook was deleted or its token reset, so the directory's copy is
+        # stale too; the next setup command in that guild lists webhooks again
+        if status not in (401, 404):
+            return
+        channel = self.get_channel(setup["to_channel"])
+        guild = getattr(channel, "guild", None) or message.guild
+        if guild is not None:
+            self.webhook_directory.invalidate(guild.id)
+
+    def webhook_content(self, message, response, setup):
+        if not setup['delete_messages']:
+            kanal = message.channel.id
+            idka = message.id
+            return f"{response}\n||https://discord.com/channels/{kanal}/{kanal}/{idka}||"
+        return f"{response}\n"
+
     async def send_webhook(self, message, response, author, setup, avatar):
         webhook_id = setup.get("webhook_id")
         webhook_token = setup.get("webhook_token")
         if not author.strip():
             author = "spomqinson"
         if webhook_id and webhook_token:
-            webhook_url = f"https://discord.com/api/webhooks/{webhook_id}/{webhook_token}"
             excesska = author[80:]
-            resp = f"{response}\n"
-            if not setup['delete_messages']:
-                kanal = message.channel.id
-                idka = message.id
-                resp = f"{response}\n||https://discord.com/channels/{kanal}/{kanal}/{idka}||"
+            resp = self.webhook_content(message, response, setup)
             #if excesska:
                 #resp = f"{excesska}:\n{resp}"
             webhook_data = {
@@ -265,35 +2201,83 @@ class Translatiob(commands.Bot):
             }
             
             # Send the webhook and get the response
-            webhook_response = requests.post(webhook_url, json=webhook_data)
+            with trace_span("webhook"):
+                webhook_response = await self.webhooks.send(webhook_id, webhook_token, webhook_data)
+            if not webhook_response.ok:
+                self.logger.error(f"Webhook {webhook_id} not delivered: {webhook_response.status} {webhook_response.error or webhook_response.data}")
+                self.forget_webhook(message, setup, webhook_response.status)
             return webhook_response, resp
 
     @tasks.loop(seconds=60*5)
     async def clear_names(self):
-        if self._blocked:
+        expired = self.nick_cache.prune()
+        if expired:
+            self.logger.info(f"Expired {expired} names from nick_cache.")
+        if NICK_CACHE_FILE:
+            await asyncio.to_thread(self.save_nick_cache, self.nick_cache.dump())
+
+    def load_nick_cache(self):
+        if not NICK_CACHE_FILE:
+            return
+        try:
+            with open(NICK_CACHE_FILE, 'r') as f:
+                entries = json.load(f)
+            self.nick_cache.load(((author, model), nick, stamp) for author, model, nick, stamp in entries)
+        except (FileNotFoundError, json.JSONDecodeError, ValueError, TypeError):
             return
-        if self.nick_cache:
-            random_key = random.choice(list(self.nick_cache.keys()))
-            del self.nick_cache[random_key]
-            self.logger.info(f"Removed '{random_key}' from nick_cache.")
+
+    def save_nick_cache(self, entries):
+        tmp_file = f"{NICK_CACHE_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump([[author, model, nick, stamp] for (author, model), nick, stamp in entries], f)
+        os.replace(tmp_file, NICK_CACHE_FILE)
+
+    async def close(self):
+        await self.shutdown()
+        await super().close()
+
+    async def shutdown(self):
+        # shard processes never fill the nick cache, keep them off the worker's file
+        if NICK_CACHE_FILE and self.worker is None:
+            self.save_nick_cache(self.nick_cache.dump())
+        await self.deleter.close()
+        await self.webhooks.close()
+        self.setup_store.close(self.setups)
+        if self.spool is not None:
+            self.spool.close()
  
+    def put_setup(self, key, setup):
+        self.setups[key] = setup
+        self.setup_index.update(key, setup)
+
     def load_setups(self):
-        try:
-            with open(SETUP_FILE, 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+        return self.setup_store.load()
 
-    def save_setups(self):
-        with open(SETUP_FILE, 'w') as f:
-            json.dump(self.setups, f)
+    def save_setups(self, *keys):
+        self.setup_store.mark(self.setups, keys or self.setups.keys())
 
     async def create_webhook(self, channel):
         # Create a new webhook in the destination channel
         webhook = await channel.create_webhook(name=f"{self.user.name} Webhook")
         return webhook
 
-bot = Translatiob(top_layer_port=5556)
+def parse_role(argv):
+    # translatiob.py                 one process does everything
+    # translatiob.py worker          generation/delivery process for the shards
+    # translatiob.py shard 0-3       gateway shards 0..3 of SHARD_COUNT, relaying to the worker
+    role = argv[1] if len(argv) > 1 else None
+    shard_ids = None
+    if role == "shard":
+        # every shard process has to agree on the count, so it can't be left to discord
+        if SHARD_COUNT is None:
+            raise SystemExit("shard mode needs SHARD_COUNT set in config")
+        shard_ids = parse_shard_ids(argv[2])
+        if any(shard_id >= SHARD_COUNT for shard_id in shard_ids):
+            raise SystemExit(f"shard ids {argv[2]} out of range for SHARD_COUNT = {SHARD_COUNT}")
+    return role, shard_ids
+
+role, shard_ids = parse_role(sys.argv) if __name__ == "__main__" else (None, None)
+bot = Translatiob(top_layer_port=5556, shard_ids=shard_ids)
 
 
 
@@ -325,25 +2309,70 @@ async def try_fetch_channel(ctx, channel_str):
 def toggle_existing(key, state):
     if key in bot.setups:
         bot.setups[key]['disabled'] = state
-        bot.save_setups()
+        bot.setup_index.update(key, bot.setups[key])
+        bot.save_setups(key)
         return True, bot.setups[key]['disabled']
     return False, None
 
-async def manage_webhooker(channel):
-    webhook = None
-    existing_webhook = None
-    webhooks = await channel.webhooks()
-    
-    for webhook in webhooks:
-        if webhook.name == 'GUANGDONG CAWOLO HARRAQ TECHNOLOGY CO., LTD':  # You can also match by other attributes if needed
-            existing_webhook = webhook
-            break
+async def manage_webhooker(channel, verify=True):
+    # single setups check the cached webhook still exists, one fetch instead of
+    # listing the guild again; onboarding a whole guild trusts its fresh listing
+    return await bot.webhook_directory.get_or_create(channel, verify=verify)
+
+SPLIT_PATTERNS = (r"\n\s*", r"(?<=[.!?。！？])\s+", r"\s+")
+
+def split_text(text, limit, patterns=SPLIT_PATTERNS):
+    # paragraphs, then sentences, then words; the pieces keep their trailing
+    # whitespace so "".join(split_text(text, limit)) == text
+    if len(text) <= limit:
+        return [text]
+    if not patterns:
+        return [text[i:i + limit] for i in range(0, len(text), limit)]
+    pieces = []
+    start = 0
+    for match in re.finditer(patterns[0], text):
+        if match.end() > start:
+            pieces.append(text[start:match.end()])
+            start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if len(piece) > limit:
+            if current:
+                chunks.append(current)
+            *head, current = split_text(piece, limit, patterns[1:])
+            chunks += head
+        elif len(current) + len(piece) > limit:
+            chunks.append(current)
+            current = piece
+        else:
+            current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def chunk_lines(lines, limit=2000):
+    chunks = []
+    current_chunk = ""
+    for line in lines:
+        # a single line over the limit gets hard split
+        while len(line) > limit:
+            if current_chunk:
+                chunks.append(current_chunk)
+                current_chunk = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current_chunk and len(current_chunk) + len(line) + 1 > limit:
+            chunks.append(current_chunk)
+            current_chunk = line
+        else:
+            current_chunk += "\n" + line if current_chunk else line
     
-    if existing_webhook is None:
-        webhook = await channel.create_webhook(name='GUANGDONG CAWOLO HARRAQ TECHNOLOGY CO., LTD')
-    else:
-        webhook = existing_webhook
-    return webhook
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
 
 def format_discord_mentions(data):
     activeka = []
@@ -363,10 +2392,11 @@ def format_discord_mentions(data):
         else:
             dest = "Unknown"
         
+        packed = f", {v['delivery']}" if v.get('delivery', "each") != "each" else ""
         if not v['disabled']:
-            activeka.append(f"{str(k)[:5]}(m={v['model']}, d={v['recursion_depth']}): {source} -> {dest}")
+            activeka.append(f"{str(k)[:5]}(m={v['model']}, d={v['recursion_depth']}{packed}): {source} -> {dest}")
         else:
-            disabledka.append(f"{str(k)[:5]}(m={v['model']}, d={v['recursion_depth']}): {source} -> {dest}")
+            disabledka.append(f"{str(k)[:5]}(m={v['model']}, d={v['recursion_depth']}{packed}): {source} -> {dest}")
         
     return activeka, disabledka
 
@@ -408,11 +2438,59 @@ async def cfg(ctx, keyska, val: float):
             bot.llmcfg[keyska] = bool(val)
         else:
             bot.llmcfg[keyska] = int(val) if val > 0 else None
+        # new settings mean new profiles, backends get them registered on next use
+        bot.profiles.clear()
+        if bot.worker is not None:
+            # only the key that changed, other shards may have moved the rest since
+            await bot.worker.safe_send({"from": "translatiob", "type": "cfg", "llmcfg": {keyska: bot.llmcfg[keyska]}})
         await ctx.send(f'NEW HIS {keyska} NEW!!!!! {bot.llmcfg[keyska]}')
     else:
         await ctx.send(f"ahahah mr     anushka you wrongs it agains")
         
 
+@bot.tree.command(name="cachka")
+async def cachka_slash(interaction: discord.Interaction):
+    await interaction.response.defer()
+    ctx = await bot.get_context(interaction)
+    await cachka(ctx)
+
+@bot.command(name='cachka')
+async def cachka(ctx):
+    if ctx.author.id not in AUTHORIZED_USER_IDS and not any(role.id in AUTHORIZED_ROLE_IDS for role in ctx.author.roles):
+        await ctx.send("YOU WRONGS IT YOU ANTI PERMISSIONS")
+        return
+    stats = await bot.cache_stats()
+    if not isinstance(stats, dict):
+        await ctx.send("cachka NOT HIS")
+        return
+    if stats["bypassed"]:
+        await ctx.send("cachka BYPASSKA temperature")
+        return
+    sampled = f" (SAMPLKA temperature, {stats['sampled_ttl']}s)" if stats.get("sampled_ttl") else ""
+    await ctx.send(f"cachka{sampled}: {stats['size']}/{stats['max_size']} his, hit {stats['hits']} miss {stats['misses']} ({stats['hit_rate']:.1%})")
+
+@bot.tree.command(name="deliveryka")
+@app_commands.choices(mode=[app_commands.Choice(name=m, value=m) for m in DELIVERY_MODES])
+async def deliveryka_slash(interaction: discord.Interaction, mode: str):
+    await interaction.response.defer()
+    ctx = await bot.get_context(interaction)
+    await deliveryka(ctx, mode)
+
+@bot.command(name='deliveryka')
+async def deliveryka(ctx, mode: str):
+    if ctx.author.id not in AUTHORIZED_USER_IDS and not any(role.id in AUTHORIZED_ROLE_IDS for role in ctx.author.roles):
+        await ctx.send("YOU WRONGS IT YOU ANTI PERMISSIONS")
+        return
+    if mode not in DELIVERY_MODES:
+        await ctx.send(f"ahahah mr     anushka you wrongs it agains ({', '.join(DELIVERY_MODES)})")
+        return
+    keys = [k for k, v in bot.setups.items() if v['to_channel'] == ctx.channel.id]
+    for key in keys:
+        bot.setups[key]['delivery'] = mode
+    if keys:
+        bot.save_setups(*keys)
+    await ctx.send(f"{mode} his {len(keys)} webhookers {ctx.channel.mention}")
+
 @bot.tree.command(name="hiyou")
 @app_commands.choices(model=bot.models_decice)
 async def hiyou_slash(interaction: discord.Interaction, user: discord.Member,  model: str = 't5-mihm', recursion_depth: int = 0):
@@ -432,7 +2510,7 @@ async def hiyou(ctx, user: discord.Member, model: str = 't5-mihm', recursion_dep
     #    await ctx.send(f'IYTESBUSINESS {ctx.channel.mention}! {state}')
     #    return
     webhook = await manage_webhooker(ctx.channel)
-    bot.setups[key] = {
+    bot.put_setup(key, {
         "created_in": ctx.channel.id,
         "from_author": user.id,
         "from_server": None,
@@ -444,8 +2522,8 @@ async def hiyou(ctx, user: discord.Member, model: str = 't5-mihm', recursion_dep
         "model": model,
         "disabled": False,
         "recursion_depth": min(MAX_RECURSION_DEPTH, max(0, recursion_depth))
-    }
-    bot.save_setups()
+    })
+    bot.save_setups(key)
 
     await ctx.send(f'Ready for business? <@{user.id}>')
 
@@ -492,7 +2570,7 @@ async def translatekaONKA(ctx, to_channel: str = None, from_channel: str = None,
             await ctx.send(f'IYTESBUSINESS {ctx.channel.mention}! {state}')
             return
         webhook = await manage_webhooker(ctx.channel)
-        bot.setups[key] = {
+        bot.put_setup(key, {
             "created_in": ctx.channel.id,
             "from_author": None,
             "from_server": None,
@@ -504,8 +2582,8 @@ async def translatekaONKA(ctx, to_channel: str = None, from_channel: str = None,
             "model": model,
             "disabled": False,
             "recursion_depth": min(MAX_RECURSION_DEPTH, max(0, recursion_depth))
-        }
-        bot.save_setups()
+        })
+        bot.save_setups(key)
         await ctx.send(f'IYTESBUSINESS {ctx.channel.mention}!')
     elif from_channel and to_channel:
         key = str(from_channel.id+to_channel.id)
@@ -514,7 +2592,7 @@ async def translatekaONKA(ctx, to_channel: str = None, from_channel: str = None,
             await ctx.send(f'IYTESBUSINESS {ctx.channel.mention}! {state}')
             return
         webhook = await manage_webhooker(to_channel)
-        bot.setups[key] = {
+        bot.put_setup(key, {
             "created_in": ctx.channel.id,
             "from_author": None,
             "from_server": None,
@@ -526,8 +2604,8 @@ async def translatekaONKA(ctx, to_channel: str = None, from_channel: str = None,
             "model": model,
             "disabled": False,
             "recursion_depth": min(MAX_RECURSION_DEPTH, max(0, recursion_depth))
-        }
-        bot.save_setups()  # Save setups after modification
+        })
+        bot.save_setups(key)  # Save setups after modification
         await ctx.send(f'OIYESBUSINESS {from_channel.mention} -> {to_channel.mention} Webhooker.')
     elif to_channel:
         key = str(ctx.guild.id+to_channel.id)
@@ -536,7 +2614,7 @@ async def translatekaONKA(ctx, to_channel: str = None, from_channel: str = None,
             await ctx.send(f'IYTESBUSINESS {ctx.channel.mention}!')
             return
         webhook = await manage_webhooker(to_channel)
-        bot.setups[key] = {
+        bot.put_setup(key, {
             "created_in": ctx.channel.id,
             "from_author": None,
             "from_server": ctx.guild.id,
@@ -548,8 +2626,8 @@ async def translatekaONKA(ctx, to_channel: str = None, from_channel: str = None,
             "model": model,
             "disabled": False,
             "recursion_depth": min(MAX_RECURSION_DEPTH, max(0, recursion_depth))
-        }
-        bot.save_setups()  # Save setups after modification
+        })
+        bot.save_setups(key)  # Save setups after modification
         await ctx.send(f'oyes uinesss Server -> {to_channel.mention} WEbholker .')
 
 @bot.command(name='translatekaONKA_all')
@@ -566,17 +2644,22 @@ async def translatekaONKA_all(ctx, model: str = 't5-mihm', recursion_depth: int
         return
     
     setup_channels = []
+    setup_keys = []
     failed_channels = []
     
     message = await ctx.send(f"MMMMMMMMMMMMMMMMM {len(channels)} CHANNELS...")
-    for channel in channels:
+    limiter = asyncio.Semaphore(ONBOARD_CONCURRENCY)
+    last_progress = time.monotonic()
+
+    async def onboard(channel):
+        nonlocal last_progress
+        key = str(channel.id + channel.id)
+        if key in bot.setups:
+            return
         try:
-            key = str(channel.id + channel.id)
-            if key in bot.setups:
-                continue
-            
-            webhook = await manage_webhooker(channel)
-            bot.setups[key] = {
+            async with limiter:
+                webhook = await manage_webhooker(channel, verify=False)
+            bot.put_setup(key, {
                 "created_in": ctx.channel.id,
                 "from_author": None,
                 "from_server": None,
@@ -588,15 +2671,25 @@ async def translatekaONKA_all(ctx, model: str = 't5-mihm', recursion_depth: int
                 "model": model,
                 "disabled": False,
                 "recursion_depth": min(MAX_RECURSION_DEPTH, max(0, recursion_depth))
-            }
+            })
             setup_channels.append(channel.mention)
-            await message.edit(content=f"iyes: {len(setup_channels)}/{len(channels)}...")
-            
+            setup_keys.append(key)
         except Exception as e:
             print(f"SHIT BROO EXCEPTION <#{channel.id}>")
             failed_channels.append(channel.mention)
-    
-    bot.save_setups()
+            return
+        # the channel is set up either way, a failed progress edit is just skipped
+        if time.monotonic() - last_progress >= ONBOARD_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            try:
+                await message.edit(content=f"iyes: {len(setup_channels)}/{len(channels)}...")
+            except discord.HTTPException:
+                pass
+
+    await asyncio.gather(*(onboard(channel) for channel in channels))
+    await message.edit(content=f"iyes: {len(setup_channels)}/{len(channels)}")
+    if setup_keys:
+        bot.save_setups(*setup_keys)
     result_message = []
     
     if setup_channels:
@@ -606,19 +2699,7 @@ async def translatekaONKA_all(ctx, model: str = 't5-mihm', recursion_depth: int
         result_message.append(f"\nNoky {len(failed_channels)}:")
         result_message.extend(failed_channels)
         
-    chunks = []
-    current_chunk = ""
-    for line in result_message:
-        if len(current_chunk) + len(line) + 1 > 2000:
-            chunks.append(current_chunk)
-            current_chunk = line
-        else:
-            current_chunk += "\n" + line if current_chunk else line
-    
-    if current_chunk:
-        chunks.append(current_chunk)
-    
-    for chunk in chunks:
+    for chunk in chunk_lines(result_message):
         await ctx.send(chunk)
 
 
@@ -684,31 +2765,28 @@ async def translateka_slash(interaction: discord.Interaction, text: str, recursi
     
 @bot.command(name='translateka')
 async def translateka(ctx, *, text, recursion_depth = 0, punchka_outka = False, model: str = 't5-mihm'):
-    if not bot.LLM.is_available or text is None:
+    if not bot.backend_available or text is None:
         return
-    bot._blocked = True
     bot.logger.info(text)
     text = punch_out_random_words(text, random.randint(0, len(text.split(" "))//2))
-    response = bot.LLM.safe_send(bot.get_config(text, model))
-    for i in range(recursion_depth):
-        response = bot.LLM.safe_send(bot.get_config(text, model))
+    guild_id = ctx.guild.id if ctx.guild else None
+    # someone is waiting on this one, queueing included
+    responses = await bot.interactive_chain(guild_id, f"translateka:{ctx.author.id}", text, model, recursion_depth, time.time() + INTERACTIVE_BUDGET)
+    if responses is None:
+        await ctx.send("BUSY BUSINESSS TRY AGAINS")
+        return
+    response = responses[-1] if responses else None
 
-    author = bot.get_author(ctx)
-    bot.logger.debug(f"{author}, {bot.nick_cache}")
-    try:
-        if author not in bot.nick_cache:
-            author_ = bot.LLM.safe_send(bot.get_config(author, model))
-            if author_:
-                bot.nick_cache[author] = author_
-                author = author_
-        else:
-            author = bot.nick_cache[author]
-    except Exception as e:
-        bot.logger.error(f"HUBINTA {e}")
+    author = await bot.translate_nick(bot.get_author(ctx), model)
     bot.logger.warning(f"{author}: {text} -> {response}")
     # Forward the response via webhook
-    bot._blocked = False
     await ctx.send(response)
     return
 
-bot.run(TOKENIITA_BAXSANTA)
+if __name__ == "__main__":
+    if role == "worker":
+        asyncio.run(bot.serve_worker())
+    else:
+        if role == "shard":
+            bot.use_worker(WORKER_ENDPOINT)
+        bot.run(TOKENIITA_BAXSANTA)